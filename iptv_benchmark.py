@@ -0,0 +1,737 @@
+# Tên tệp: iptv_benchmark.py
+
+import argparse
+import asyncio
+from collections import defaultdict
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import aiohttp
+from aiohttp import web
+
+import iptv_generator_optimized as gen
+
+# =======================================================================================
+# SYNTHETIC DATA
+# =======================================================================================
+
+NAME_WORDS = ['BBC', 'News', 'Sport', 'Cinema', 'Movies', 'Kids', 'Music', 'World', 'One', 'Plus',
+              'Channel', 'Live', 'Discovery', 'Nature', 'Action', 'Drama', 'Comedy', 'Euro', 'Star', 'Max',
+              'Full', 'United', 'Costa']
+NAME_TAGS = ['', '', '', '(1080p)', 'FHD', '4K', 'UHD', '(720p)', 'SD', 'HEVC', 'H265', 'Full HD']
+GROUPS = ['', 'UK News', 'USA Sports', 'France', 'Germany', 'Movies', 'Kids', 'India', 'Spanish',
+          'Canada', 'Italy', 'Documentary', 'Music', 'Portugal', 'Netherlands', 'Australia',
+          'HD Sports', 'Kingdom', 'States', 'Rica']
+
+def synthetic_records(count, seed=42):
+    """Deterministic (name, url, attributes) records shaped like the real sources"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        name = ' '.join(rng.sample(NAME_WORDS, rng.randint(1, 3)))
+        tag = rng.choice(NAME_TAGS)
+        if tag:
+            name = f"{name} {tag}"
+        attributes = {'tvg-id': f"ch{i}.{rng.randint(0, 999)}"}
+        group = rng.choice(GROUPS)
+        if group:
+            attributes['group-title'] = group
+        url = f"http://{rng.randint(1, 250)}.{rng.randint(0, 250)}.{rng.randint(0, 250)}.{rng.randint(1, 250)}:{rng.choice([80, 8080, 82])}/live/{i}.m3u8"
+        records.append((name, url, attributes))
+    return records
+
+# =======================================================================================
+# CLASSIFICATION MICROBENCHMARK
+# =======================================================================================
+
+def reference_classify(name, group, group_present):
+    """The pre-engine per-channel logic (separate keyword scans), kept as the baseline"""
+    name_lower = name.lower()
+    country_group = group.lower() if group_present else ''
+
+    country = None
+    for blocked in gen.BLOCKED_COUNTRIES:
+        if blocked in country_group or blocked in name_lower:
+            country = 'BLOCKED'
+            break
+
+    if country is None:
+        # Dict dựng lại mỗi lần như bản cũ của _extract_country
+        country_map = {
+            'usa': 'USA', 'us': 'USA', 'united states': 'USA',
+            'uk': 'UK', 'united kingdom': 'UK', 'britain': 'UK',
+            'canada': 'CA', 'canadian': 'CA',
+            'australia': 'AU', 'aussie': 'AU',
+            'france': 'FR', 'french': 'FR',
+            'germany': 'DE', 'german': 'DE',
+            'spain': 'ES', 'spanish': 'ES',
+            'italy': 'IT', 'italian': 'IT',
+            'netherlands': 'NL', 'dutch': 'NL',
+            'portugal': 'PT', 'portuguese': 'PT',
+        }
+        country = 'INT'
+        for keyword, code in country_map.items():
+            if keyword in country_group or keyword in name_lower:
+                country = code
+                break
+
+    text = f"{name} {group}".lower()
+    score = 50
+    if any(kw in text for kw in ['4k', 'uhd', '2160']):
+        score = 100
+    elif any(kw in text for kw in ['1080', 'fhd', 'full hd', '1920']):
+        score = 80
+    if any(kw in text for kw in gen.QUALITY_KEYWORDS_EXCLUDE):
+        score = 0
+    if any(kw in text for kw in ['hevc', 'h265', 'x265']):
+        score += 15
+
+    return country, max(0, min(score, 115))
+
+def bench_classify(args):
+    records = synthetic_records(args.count)
+    items = []
+    for name, _, attributes in records:
+        clean = gen._NAME_INVALID_RE.sub('', gen._WHITESPACE_RE.sub(' ', name.strip()))[:80]
+        items.append((clean, attributes.get('group-title', 'TV'), 'group-title' in attributes))
+
+    start = time.perf_counter()
+    expected = [reference_classify(*item) for item in items]
+    reference_s = time.perf_counter() - start
+
+    engine = gen.ChannelClassifier()
+    start = time.perf_counter()
+    actual = [engine._classify(*item) for item in items]
+    engine_s = time.perf_counter() - start
+
+    engine = gen.ChannelClassifier()
+    start = time.perf_counter()
+    batched = engine.classify_many(items)
+    batch_s = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(expected, actual) if a != b)
+    assert batched == actual
+
+    start = time.perf_counter()
+    gen.build_channels(records, 'tv')
+    construct_s = time.perf_counter() - start
+
+    per = lambda seconds: seconds / args.count * 1e6
+    print(f"Classification of {args.count} channels")
+    print(f"  reference scans   : {per(reference_s):7.2f} us/channel")
+    print(f"  single-pass engine: {per(engine_s):7.2f} us/channel")
+    print(f"  engine + memo     : {per(batch_s):7.2f} us/channel")
+    print(f"  IPTVChannel build : {per(construct_s):7.2f} us/channel")
+    print(f"  mismatches vs reference: {mismatches}")
+
+# =======================================================================================
+# PARSE THROUGHPUT: EVENT LOOP vs PROCESS POOL
+# =======================================================================================
+
+def synthetic_m3u(count, seed=42):
+    lines = ['#EXTM3U']
+    for name, url, attributes in synthetic_records(count, seed):
+        attrs = ' '.join(f'{key}="{value}"' for key, value in attributes.items())
+        lines.append(f'#EXTINF:-1 {attrs},{name}')
+        lines.append(url)
+    return '\r\n'.join(lines)
+
+async def measure_loop_lag(work):
+    """Run `work` while a 10ms ticker records how long the event loop was blocked"""
+    loop = asyncio.get_event_loop()
+    worst = 0.0
+    running = True
+    
+    async def ticker():
+        nonlocal worst
+        while running:
+            before = loop.time()
+            await asyncio.sleep(0.01)
+            worst = max(worst, loop.time() - before - 0.01)
+    
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    result = await work()
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick
+    return result, elapsed, worst * 1000
+
+def bench_parse(args):
+    content = synthetic_m3u(args.count)
+    
+    async def single_loop():
+        return gen.parse_m3u_content(content, 'tv')
+    
+    async def pooled():
+        pairs = gen.parse_m3u_pairs(content)
+        futures = [
+            gen.parse_in_pool(pairs[i:i + gen.PARSE_BATCH_SIZE], 'tv')
+            for i in range(0, len(pairs), gen.PARSE_BATCH_SIZE)
+        ]
+        channels = []
+        for future in futures:
+            channels.extend(gen.IPTVChannel.from_record(record) for record in await future)
+        return channels
+    
+    async def run():
+        # Khởi động pool trước để không tính chi phí spawn process vào throughput
+        await asyncio.gather(*(gen.parse_in_pool([], 'tv') for _ in range(gen.PARSE_WORKERS)))
+        return (await measure_loop_lag(single_loop), await measure_loop_lag(pooled))
+    
+    try:
+        (single, single_s, single_lag), (pool, pool_s, pool_lag) = asyncio.run(run())
+    finally:
+        gen.shutdown_parse_pool()
+    
+    assert [ch.to_record() for ch in single] == [ch.to_record() for ch in pool]
+    print(f"Parse + classify {len(single)} channels ({len(content) / 1e6:.1f} MB M3U)")
+    print(f"  single event loop : {len(single) / single_s:9.0f} channels/s | loop blocked up to {single_lag:7.1f} ms")
+    print(f"  process pool ({gen.PARSE_WORKERS:>2}) : {len(pool) / pool_s:9.0f} channels/s | loop blocked up to {pool_lag:7.1f} ms")
+
+# =======================================================================================
+# CHANNEL TABLE vs OBJECT LIST
+# =======================================================================================
+
+def reference_filter(channels):
+    """The pre-table filter_and_deduplicate (list comprehensions + separate stats passes)"""
+    working = [ch for ch in channels if ch.status == 'working']
+    high_quality = [ch for ch in working if ch.is_high_quality()]
+    fast_channels = [ch for ch in high_quality if ch.ping <= gen.MAX_ACCEPTABLE_PING_MS]
+    
+    url_map = {}
+    for ch in fast_channels:
+        if ch.url_key not in url_map or ch.ping < url_map[ch.url_key].ping:
+            url_map[ch.url_key] = ch
+    
+    final_map = {}
+    for ch in url_map.values():
+        key = (ch.name_normalized, ch.country, ch.category)
+        if key not in final_map:
+            final_map[key] = ch
+        else:
+            existing = final_map[key]
+            if (ch.quality_score > existing.quality_score or
+                (ch.quality_score == existing.quality_score and ch.ping < existing.ping)):
+                final_map[key] = ch
+    
+    final = list(final_map.values())
+    final.sort(key=lambda x: (x.category, -x.quality_score, x.ping))
+    
+    stats = (
+        len([ch for ch in final if ch.quality_score >= 100]),
+        len([ch for ch in final if 80 <= ch.quality_score < 100]),
+        len([ch for ch in final if ch.quality_score == 50]),
+        len([ch for ch in final if 50 < ch.quality_score < 80]),
+        len([ch for ch in final if ch.ping <= gen.EXCELLENT_PING_MS]),
+        len([ch for ch in final if gen.EXCELLENT_PING_MS < ch.ping <= gen.GOOD_PING_MS]),
+        len([ch for ch in final if ch.ping > gen.GOOD_PING_MS]),
+    )
+    return final, stats
+
+def synthetic_channels(records, seed=7):
+    """Yield probed channels (parse-time fields from records, random status/ping)"""
+    rng = random.Random(seed)
+    for record in records:
+        ch = gen.IPTVChannel.from_record(record)
+        if rng.random() < 0.08:
+            ch.status = 'working'
+            ch.ping = rng.uniform(50, 4500)
+        else:
+            ch.status = rng.choice(['timeout', 'error', 'rejected'])
+        yield ch
+
+def fresh_records(records):
+    return [tuple(v.encode().decode() if isinstance(v, str) else v for v in record) for record in records]
+
+def traced_size(build):
+    """Bytes still allocated by `build()`'s result once its temporaries are gone"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+def synthetic_table(records, seed=7):
+    """synthetic_channels() ingested the way main() does it: rows from records, verdicts into the columns"""
+    rng = random.Random(seed)
+    table = gen.ChannelTable()
+    working = table.statuses.code('working')
+    for record in records:
+        row = table.append_record(record)
+        if rng.random() < 0.08:
+            table.status[row] = working
+            table.ping[row] = rng.uniform(50, 4500)
+        else:
+            table.status[row] = table.statuses.code(rng.choice(['timeout', 'error', 'rejected']))
+    return table
+
+def bench_table(args):
+    logging.disable(logging.INFO)
+    # reference_filter chỉ gộp tên trùng khớp hoàn toàn
+    gen.FUZZY_DEDUP = False
+    for count in sorted({args.count, 500000}):
+        # Record + URL trùng lặp giống dữ liệu thật (~10% URL xuất hiện ở nhiều nguồn)
+        records = [ch.to_record() for ch in gen.build_channels(synthetic_records(count), 'tv')]
+        records += records[:count // 10]
+        
+        # Bộ nhớ: mỗi cấu trúc dựng từ bản sao string riêng để phần string nó giữ lại cũng được đếm
+        objects_bytes = traced_size(lambda: list(synthetic_channels(fresh_records(records))))[1]
+        table_bytes = traced_size(lambda: synthetic_table(fresh_records(records)))[1]
+        
+        # Thời gian dựng đo riêng (tracemalloc làm chậm mọi lần cấp phát).
+        # gc.collect() trước mỗi phần đo: GC thế hệ 2 quét cả đống record của benchmark,
+        # rơi vào phần nào là cộng vài trăm ms vào phần đó
+        copies = fresh_records(records)
+        gc.collect()
+        start = time.perf_counter()
+        objects = list(synthetic_channels(copies))
+        objects_build_s = time.perf_counter() - start
+        
+        copies = fresh_records(records)
+        gc.collect()
+        start = time.perf_counter()
+        table = synthetic_table(copies)
+        table_build_s = time.perf_counter() - start
+        del copies
+        
+        gc.collect()
+        start = time.perf_counter()
+        expected, _ = reference_filter(objects)
+        reference_s = time.perf_counter() - start
+        
+        gc.collect()
+        start = time.perf_counter()
+        actual = gen.filter_and_deduplicate(table)
+        table_s = time.perf_counter() - start
+        del objects, table
+        
+        assert sorted(ch.url_hash for ch in actual) == sorted(ch.url_hash for ch in expected)
+        print(f"Catalogue of {len(records)} channels ({len(actual)} after filtering), built from parse records")
+        print(f"  IPTVChannel list : {objects_bytes / 2**20:7.1f} MiB | build {objects_build_s * 1000:7.1f} ms"
+              f" | filter {reference_s * 1000:6.1f} ms | total {(objects_build_s + reference_s) * 1000:7.1f} ms")
+        print(f"  ChannelTable     : {table_bytes / 2**20:7.1f} MiB | build {table_build_s * 1000:7.1f} ms"
+              f" | filter {table_s * 1000:6.1f} ms | total {(table_build_s + table_s) * 1000:7.1f} ms")
+    logging.disable(logging.NOTSET)
+
+# =======================================================================================
+# NEAR-DUPLICATE CLUSTERING
+# =======================================================================================
+
+SYLLABLES = [onset + vowel + coda for onset in ['', 'b', 'd', 'f', 'g', 'k', 'l', 'm', 'n', 'p', 'r', 's', 't',
+                                                'v', 'z', 'st', 'tr', 'sk']
+             for vowel in 'aeiou' for coda in ['', 'n', 'r', 'x']]
+VARIANT_NOISE = ['', '', '', ' Channel', ' HEVC', ' (1080p) (HEVC)', ' [Geo-blocked]', ' [Not 24/7]',
+                 ' FHD', ' H265', ' Backup']
+CLUSTER_COUNTRIES = ['uk', 'us', 'fr', 'de', 'it', 'ca']
+
+def synthetic_variants(count, seed=11):
+    """Records written as variants of count // 6 distinct channels; returns (records, channel id per record)"""
+    rng = random.Random(seed)
+    bases = []
+    for _ in range(max(1, count // 6)):
+        words = [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).title()
+                 for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.2:
+            words.append(str(rng.randint(1, 5)))
+        bases.append((' '.join(words), rng.choice(CLUSTER_COUNTRIES), rng.choice(GROUPS)))
+    
+    records, truth = [], []
+    for i in range(count):
+        base = rng.randrange(len(bases))
+        name, country, group = bases[base]
+        if rng.random() < 0.15:
+            name = name.replace(' ', '', 1)  # "Euro Sport" / "EuroSport"
+        name += rng.choice(VARIANT_NOISE)
+        attributes = {'group-title': group} if group else {}
+        if rng.random() < 0.5:
+            attributes['tvg-id'] = f"{bases[base][0].replace(' ', '')}.{country}"
+        records.append((name, f"http://10.0.{i % 250}.{i % 199 + 1}/live/{i}.m3u8", attributes))
+        truth.append(base)
+    return records, truth
+
+def pairwise_clusters(blocks, names, tvg_ids, threshold):
+    """Quadratic reference: the same linking rules checked on every pair of a block"""
+    items = [(gen.cluster_signature(name), gen._epg_key(tvg_id)) for name, tvg_id in zip(names, tvg_ids)]
+    grams = [gen._trigrams(text) for (text, _), _ in items]
+    labels = list(range(len(names)))
+    for a in range(len(names)):
+        for b in range(a):
+            if blocks[a] != blocks[b] or labels[a] == labels[b]:
+                continue
+            (sig_a, epg_a), (sig_b, epg_b) = items[a], items[b]
+            overlap = len(grams[a] & grams[b])
+            if (sig_a == sig_b or (epg_a is not None and epg_a == epg_b) or
+                    (sig_a[1] == sig_b[1] and overlap >= threshold * len(grams[a] | grams[b]))):
+                old, new = max(labels[a], labels[b]), min(labels[a], labels[b])
+                labels = [new if label == old else label for label in labels]
+    return labels
+
+def same_cluster_pairs(labels):
+    groups = defaultdict(list)
+    for item, label in enumerate(labels):
+        groups[label].append(item)
+    return {(a, b) for members in groups.values() for i, a in enumerate(members) for b in members[:i]}
+
+def bench_cluster(args):
+    threshold = gen.FUZZY_DEDUP_THRESHOLD
+    
+    # LSH là xấp xỉ: đo xem nó tìm lại được bao nhiêu cặp mà phép so từng cặp gộp (tập nhỏ)
+    channels = gen.build_channels(synthetic_variants(1500)[0], 'tv')
+    columns = ([(ch.country, ch.category) for ch in channels], [ch.name_normalized for ch in channels],
+               [ch.attributes['tvg-id'] for ch in channels])
+    start = time.perf_counter()
+    expected = pairwise_clusters(*columns, threshold)
+    pairwise_s = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = gen.cluster_near_duplicates(*columns, threshold=threshold)
+    indexed_s = time.perf_counter() - start
+    expected_pairs, actual_pairs = same_cluster_pairs(expected), same_cluster_pairs(actual)
+    recall = len(expected_pairs & actual_pairs) / max(1, len(expected_pairs))
+    assert actual_pairs <= expected_pairs  # Mọi cặp được gộp đều đã qua cùng phép kiểm tra Jaccard
+    assert recall >= 0.98, recall
+    print(f"{len(channels)} channels: pairwise {pairwise_s * 1000:.0f} ms | LSH {indexed_s * 1000:.1f} ms"
+          f" | pair recall {recall:.2%}")
+    
+    # Thời gian đo hai lần: với GC bật (thực tế) và GC tạm dừng (chỉ phần thuật toán;
+    # GC thế hệ duyệt lại cả heap đang lớn dần nên tự nó đã không tuyến tính)
+    print(f"{'channels':>9} {'true':>8} {'clusters':>8} {'pure':>6} {'seconds':>8} {'us/channel':>10}"
+          f" {'no-gc us/channel':>17}")
+    baseline = None
+    for count in sorted({args.count, 25000, 100000, 250000, 500000}):
+        records, truth = synthetic_variants(count)
+        channels = gen.build_channels(records, 'tv')
+        columns = ([(ch.country, ch.category) for ch in channels], [ch.name_normalized for ch in channels],
+                   [ch.attributes['tvg-id'] for ch in channels])
+        del channels
+        start = time.perf_counter()
+        labels = gen.cluster_near_duplicates(*columns, threshold=threshold)
+        elapsed = time.perf_counter() - start
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            gen.cluster_near_duplicates(*columns, threshold=threshold)
+            no_gc = (time.perf_counter() - start) / count * 1e6
+        finally:
+            gc.enable()
+        
+        # Cụm "thuần" = mọi bản ghi trong cụm là biến thể của cùng một kênh gốc
+        members = defaultdict(set)
+        for label, base in zip(labels, truth):
+            members[label].add(base)
+        pure = sum(len(bases) == 1 for bases in members.values()) / len(members)
+        per_item = elapsed / count * 1e6
+        baseline = baseline or no_gc
+        print(f"{count:>9} {len(set(truth)):>8} {len(members):>8} {pure:>6.1%} {elapsed:>8.2f} "
+              f"{per_item:>10.1f} {no_gc:>10.1f} (x{no_gc / baseline:.2f})")
+
+# =======================================================================================
+# END TO END AGAINST A LOCAL FAKE ORIGIN
+# =======================================================================================
+
+MEDIA_PLAYLIST = ('#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:0\n'
+                  '#EXTINF:6.0,\n{id}/0.ts\n#EXTINF:6.0,\n{id}/1.ts\n')
+SEGMENT_BODY = bytes(188 * 64)  # 64 gói MPEG-TS rỗng
+
+class FakeOrigin:
+    """aiohttp app serving synthetic M3U sources and stream endpoints with scripted behaviour
+    
+    Every stream id gets a fixed behaviour from a seeded RNG: an HTTP error, a
+    black hole (never answers), a redirect chain, or a 200 after a log-normal delay.
+    Answering streams serve a small HLS media playlist whose segments exist too, so
+    deep validation sees them as working. Streams are spread over several loopback
+    addresses so per-host limits apply.
+    """
+    
+    def __init__(self, args, seed=42):
+        self.args = args
+        self.hosts = [f"127.0.0.{i + 1}" for i in range(args.hosts)]
+        self.sources = []
+        self.behaviour = []
+        self.closing = None
+        self._runner = None
+        rng = random.Random(seed)
+        for _ in range(args.count):
+            roll = rng.random()
+            if roll < args.error_rate:
+                self.behaviour.append(('error', rng.choice([403, 404, 500, 503])))
+            elif roll < args.error_rate + args.blackhole_rate:
+                self.behaviour.append(('blackhole', None))
+            else:
+                delay = rng.lognormvariate(0, args.latency_sigma) * args.latency_ms / 1000
+                redirect = rng.random() < args.redirect_rate
+                self.behaviour.append(('redirect' if redirect else 'ok', delay))
+        
+        per_source = -(-args.count // args.sources)
+        records = synthetic_records(args.count, seed)
+        for start in range(0, args.count, per_source):
+            lines = ['#EXTM3U']
+            for i in range(start, min(start + per_source, args.count)):
+                name, _, attributes = records[i]
+                attrs = ' '.join(f'{key}="{value}"' for key, value in attributes.items())
+                lines.append(f'#EXTINF:-1 {attrs},{name}')
+                lines.append(f"http://{self.hosts[i % len(self.hosts)]}:{args.port}/stream/{i}.m3u8")
+            self.sources.append('\r\n'.join(lines).encode())
+
+    def source_urls(self):
+        return [f"http://{self.hosts[0]}:{self.args.port}/source/{i}.m3u" for i in range(len(self.sources))]
+
+    async def source(self, request):
+        return web.Response(body=self.sources[int(request.match_info['id'])], content_type='audio/x-mpegurl')
+
+    async def stream(self, request):
+        stream_id = int(request.match_info['id'])
+        kind, value = self.behaviour[stream_id]
+        if kind == 'error':
+            return web.Response(status=value)
+        if kind == 'blackhole':
+            await self.closing.wait()
+            return web.Response(status=503)
+        
+        hop = int(request.query.get('hop', 0))
+        if kind == 'redirect' and hop < self.args.redirect_hops:
+            raise web.HTTPFound(f"/stream/{stream_id}.m3u8?hop={hop + 1}")
+        await asyncio.sleep(value)
+        return web.Response(text=MEDIA_PLAYLIST.format(id=stream_id), content_type='application/vnd.apple.mpegurl')
+
+    async def segment(self, request):
+        return web.Response(body=SEGMENT_BODY, content_type='video/mp2t')
+
+    async def start(self):
+        self.closing = asyncio.Event()
+        app = web.Application()
+        app.router.add_get('/source/{id}.m3u', self.source)
+        app.router.add_route('*', '/stream/{id}.m3u8', self.stream)
+        app.router.add_get('/stream/{id}/{segment}.ts', self.segment)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        for host in self.hosts:
+            await web.TCPSite(self._runner, host, self.args.port).start()
+
+    async def stop(self):
+        # Thả các request black hole còn treo để cleanup không phải chờ chúng
+        self.closing.set()
+        await self._runner.cleanup()
+
+class RssSampler:
+    """Peak resident set size while the block runs (sampled from /proc, ru_maxrss elsewhere)"""
+    
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+def stage_report(items, seconds, latencies_ms, rss, **extra):
+    """Throughput, latency percentiles (ms) and peak RSS (MiB) of one stage"""
+    report = {
+        'items': items,
+        'seconds': round(seconds, 3),
+        'throughput_per_s': round(items / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mib': round(rss.peak / 2**20, 1),
+    }
+    if len(latencies_ms) >= 2:
+        cuts = statistics.quantiles(latencies_ms, n=100, method='inclusive')
+        report.update(p50_ms=round(cuts[49], 2), p95_ms=round(cuts[94], 2), p99_ms=round(cuts[98], 2))
+    elif latencies_ms:
+        report.update(p50_ms=round(latencies_ms[0], 2), p95_ms=round(latencies_ms[0], 2),
+                      p99_ms=round(latencies_ms[0], 2))
+    report.update(extra)
+    return report
+
+async def run_e2e(args):
+    origin = FakeOrigin(args)
+    await origin.start()
+    stages = {}
+    try:
+        resolver = gen.CachingResolver()
+        async with gen.create_session(resolver) as session:
+            # Fetch: tải + parse dạng stream qua process pool như khi chạy thật
+            await asyncio.gather(*(gen.parse_in_pool([], 'tv') for _ in range(gen.PARSE_WORKERS)))
+            
+            async def fetch(url):
+                start = time.perf_counter()
+                channels = await gen.fetch_source(session, url, 'tv')
+                return channels, (time.perf_counter() - start) * 1000
+            
+            with RssSampler() as rss:
+                start = time.perf_counter()
+                fetched = await asyncio.gather(*(fetch(url) for url in origin.source_urls()))
+                elapsed = time.perf_counter() - start
+            channels = [ch for batch, _ in fetched for ch in batch]
+            stages['fetch_source'] = stage_report(
+                len(channels), elapsed, [ms for _, ms in fetched], rss,
+                sources=len(fetched), mb=round(sum(len(body) for body in origin.sources) / 1e6, 2))
+            
+            # Parse: cùng các body, parse_m3u_content trên event loop (không pool, không mạng)
+            texts = [body.decode() for body in origin.sources]
+            latencies = []
+            with RssSampler() as rss:
+                start = time.perf_counter()
+                parsed = 0
+                for text in texts:
+                    begin = time.perf_counter()
+                    parsed += len(gen.parse_m3u_content(text, 'tv'))
+                    latencies.append((time.perf_counter() - begin) * 1000)
+                elapsed = time.perf_counter() - start
+            stages['parse_m3u_content'] = stage_report(parsed, elapsed, latencies, rss)
+            
+            # Check: đúng đường main() dùng — ProbeScheduler (worker pool, AIMD theo host,
+            # hàng đợi ưu tiên, deadline) cùng bước quét DNS/TCP trước khi probe
+            candidates = [ch for ch in channels if ch.is_high_quality()]
+            sweep = gen.EndpointSweep(resolver) if gen.PREPROBE_SWEEP else None
+            scheduler = gen.ProbeScheduler(session, deadline=gen.PROBE_DEADLINE, sweep=sweep)
+            with RssSampler() as rss:
+                start = time.perf_counter()
+                await scheduler.run(candidates)
+                elapsed = time.perf_counter() - start
+            outcomes = {}
+            for ch in candidates:
+                key = ch.status if ch.status != 'dead' else f"dead:{ch.reason or 'unknown'}"
+                outcomes[key] = outcomes.get(key, 0) + 1
+            latencies = [ch.timing.total_ms() for ch in candidates
+                         if ch.timing is not None and ch.timing.ended is not None]
+            stages['probe_scheduler'] = stage_report(
+                len(candidates), elapsed, latencies, rss, outcomes=outcomes,
+                unique_streams=len(scheduler.index.groups), unreachable=scheduler.unreachable,
+                failed_fast=scheduler.failed_fast, expired=scheduler.expired)
+            
+            # Deep validation: manifest của các stream working (như main() khi DEEP_VALIDATION)
+            if gen.DEEP_VALIDATION and not scheduler.expired:
+                working = sum(1 for ch in candidates if ch.status == 'working')
+                with RssSampler() as rss:
+                    start = time.perf_counter()
+                    await gen.deep_validate(session, scheduler.index)
+                    elapsed = time.perf_counter() - start
+                stages['deep_validate'] = stage_report(
+                    working, elapsed, [], rss,
+                    still_working=sum(1 for ch in candidates if ch.status == 'working'))
+            
+            with RssSampler() as rss:
+                start = time.perf_counter()
+                final = gen.filter_and_deduplicate(gen.ChannelTable.from_channels(candidates))
+                elapsed = time.perf_counter() - start
+            stages['filter_and_deduplicate'] = stage_report(
+                len(candidates), elapsed, [elapsed * 1000], rss, final=len(final))
+        await resolver.close()
+    finally:
+        await origin.stop()
+    return stages
+
+def bench_e2e(args):
+    logging.disable(logging.INFO)
+    gen.CHANNEL_CHECK_TIMEOUT = args.probe_timeout
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Cache nguồn riêng cho mỗi lần đo: luôn tải lại toàn bộ body
+        gen.SOURCE_CACHE_DIR = cache_dir
+        try:
+            stages = asyncio.run(run_e2e(args))
+        finally:
+            gen.shutdown_parse_pool()
+    logging.disable(logging.NOTSET)
+    
+    result = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'aiohttp': aiohttp.__version__,
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'stages': stages,
+    }
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=1)
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['stages']
+    
+    print(f"End to end: {args.count} channels, {args.sources} sources, {args.hosts} hosts")
+    for name, stage in stages.items():
+        line = (f"  {name:<22}: {stage['throughput_per_s'] or 0:9.0f}/s | "
+                f"p50 {stage.get('p50_ms', 0):8.1f} ms | p95 {stage.get('p95_ms', 0):8.1f} ms | "
+                f"p99 {stage.get('p99_ms', 0):8.1f} ms | peak RSS {stage['peak_rss_mib']:7.1f} MiB")
+        old = baseline.get(name) if baseline else None
+        if old and old.get('throughput_per_s') and stage['throughput_per_s']:
+            line += f" | throughput x{stage['throughput_per_s'] / old['throughput_per_s']:.2f} vs baseline"
+        print(line)
+    print(f"  outcomes: {stages['probe_scheduler']['outcomes']}")
+    if 'deep_validate' in stages:
+        print(f"  deep validation: {stages['deep_validate']['still_working']}"
+              f"/{stages['deep_validate']['items']} still working")
+    print(f"Saved to {args.output}")
+
+# =======================================================================================
+# MAIN
+# =======================================================================================
+
+BENCHMARKS = {
+    'classify': bench_classify,
+    'cluster': bench_cluster,
+    'e2e': bench_e2e,
+    'parse': bench_parse,
+    'table': bench_table,
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the IPTV generator")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--count', type=int, default=55000, help="Synthetic channels per run")
+    
+    e2e = parser.add_argument_group("e2e (local fake origin)")
+    e2e.add_argument('--sources', type=int, default=17, help="Number of synthetic M3U sources")
+    e2e.add_argument('--hosts', type=int, default=8, help="Loopback addresses the streams are spread over")
+    e2e.add_argument('--port', type=int, default=18080)
+    e2e.add_argument('--latency-ms', type=float, default=150, help="Median stream response latency")
+    e2e.add_argument('--latency-sigma', type=float, default=0.8, help="Log-normal spread of the latency")
+    e2e.add_argument('--error-rate', type=float, default=0.3, help="Share of streams answering 4xx/5xx")
+    e2e.add_argument('--blackhole-rate', type=float, default=0.02, help="Share of streams that never answer")
+    e2e.add_argument('--redirect-rate', type=float, default=0.1, help="Share of streams behind a redirect chain")
+    e2e.add_argument('--redirect-hops', type=int, default=2)
+    e2e.add_argument('--probe-timeout', type=float, default=2, help="CHANNEL_CHECK_TIMEOUT for the run")
+    e2e.add_argument('--label', default='', help="Free-form version label stored with the results")
+    e2e.add_argument('--output', default=os.path.join(gen.REPORT_DIR, 'bench_e2e.json'))
+    e2e.add_argument('--compare', help="Earlier results JSON to compare throughput against")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)
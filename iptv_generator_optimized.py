@@ -1,14 +1,36 @@
 # Tên tệp: iptv_generator_optimized.py
 
+import argparse
 import asyncio
 import aiohttp
+from aiohttp import web
+from array import array
+import codecs
+import csv
+import gzip
 import re
 import logging
+import multiprocessing
 from datetime import datetime
-from collections import defaultdict
-from urllib.parse import urlparse
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left
+import heapq
+from urllib.parse import urljoin, urlparse, urlsplit
 import hashlib
+import json
+import os
+import posixpath
+import random
+import socket
+import statistics
 import sys
+import time
+
+try:
+    import brotli  # Tuỳ chọn: thêm body nén brotli cho server
+except ImportError:
+    brotli = None
 
 # =======================================================================================
 # CONFIGURATION CHẤT LƯỢNG CAO - STRICT FILTERING
@@ -39,6 +61,13 @@ SOURCES = {
 }
 
 OUTPUT_FILENAME = "playlist.m3u"
+DELTA_FILENAME = "playlist.delta.json"  # Kênh thêm/bớt/đổi vị trí so với lần publish trước
+FALLBACK_FILENAME = "playlist.fallbacks.json"  # Stream dự phòng của từng kênh (theo url_hash)
+
+# SHARD: playlist con theo category / country / group-title + index JSON nhỏ cho client
+SHARD_OUTPUT = True
+SHARD_DIR = "shards"
+SHARD_INDEX_FILENAME = os.path.join(SHARD_DIR, "index.json")
 
 # THÔNG SỐ CHẤT LƯỢNG CAO
 CHANNEL_CHECK_TIMEOUT = 5   
@@ -65,8 +94,91 @@ BLOCKED_COUNTRIES = [
     'lao', 'laos', 'la'
 ]
 
-# BATCH SIZE
-BATCH_SIZE = 200
+# GỘP KÊNH GẦN TRÙNG TÊN ("BBC News (1080p) (HEVC)" / "BBC News Channel") trong cùng quốc gia + category
+FUZZY_DEDUP = True              # False = chỉ gộp khi tên chuẩn hoá trùng khớp hoàn toàn (như cũ)
+FUZZY_DEDUP_THRESHOLD = 0.75    # Jaccard tối thiểu giữa hai tập trigram của tên
+FUZZY_DEDUP_FALLBACKS = 1       # Số stream dự phòng mỗi cụm, ghi vào FALLBACK_FILENAME (không thêm vào playlist)
+FUZZY_DEDUP_BANDS = 10          # MinHash-LSH: 10 band x 3 hash (Jaccard 0.75 -> ~99.6% thành ứng viên)
+FUZZY_DEDUP_ROWS = 3
+FUZZY_DEDUP_SCAN_LIMIT = 50     # Số ứng viên tối đa so với mỗi bucket (chặn trường hợp xấu nhất)
+
+# GIỚI HẠN THEO HOST (AIMD): tăng dần khi host trả lời nhanh, giảm một nửa khi timeout/lỗi
+HOST_INITIAL_CONCURRENCY = 4
+HOST_MAX_CONCURRENCY = 32
+HOST_TARGET_LATENCY_MS = 1500  # Chậm hơn mức này thì giảm nhẹ concurrency của host
+HOST_FAILFAST_TIMEOUTS = 3     # Host chưa trả lời lần nào mà timeout liên tiếp -> bỏ qua các URL còn lại
+
+# PIPELINE: tải, lọc và kiểm tra chạy song song (False = 3 pha tuần tự như cũ)
+PIPELINE_MODE = True
+PIPELINE_QUEUE_SIZE = 5000  # Số kênh tối đa chờ giữa hai stage
+
+# DEEP VALIDATION: đọc manifest HLS/DASH của kênh đã qua HEAD để lấy độ phân giải thật
+DEEP_VALIDATION = True
+DEEP_VALIDATION_MAX = 3000          # Số stream tối đa mỗi lần chạy
+DEEP_VALIDATION_CONCURRENCY = 50
+DEEP_VALIDATION_TIMEOUT = 4
+MANIFEST_MAX_BYTES = 128 * 1024     # Ngân sách byte cho mỗi manifest
+SEGMENT_PROBE = False               # Tải thử đầu segment đầu tiên (TTFB + throughput)
+SEGMENT_PROBE_BYTES = 256 * 1024
+
+# BÁO CÁO: thời gian từng pha (DNS/connect/TTFB) của mỗi probe
+REPORT_DIR = "reports"
+PROBE_TIMINGS_JSON = os.path.join(REPORT_DIR, "probe_timings.json")
+PROBE_TIMINGS_CSV = os.path.join(REPORT_DIR, "probe_timings.csv")
+RUN_REPORT_JSON = os.path.join(REPORT_DIR, "run_report.json")  # Metrics + yield từng nguồn của lần chạy
+METRICS_PROM = os.path.join(REPORT_DIR, "metrics.prom")        # Prometheus text format (textfile collector)
+RUN_HISTORY = os.path.join(REPORT_DIR, "run_history.jsonl")    # Mỗi lần chạy thêm một dòng
+
+# DAEMON (--daemon): giữ session ấm, kiểm tra lại kênh liên tục thay vì chạy theo cron
+DAEMON_PROBE_RATE = 10              # Probe/giây ở trạng thái ổn định
+DAEMON_STARTUP_PROBE_RATE = 60      # Probe/giây khi còn stream chưa kiểm tra lần nào
+DAEMON_WORKING_INTERVAL = 3600      # Kênh working ổn định: kiểm tra lại mỗi giờ
+DAEMON_MIN_INTERVAL = 300           # Kênh chập chờn: không kiểm tra dày hơn 5 phút
+DAEMON_SOURCE_REFRESH = 6 * 3600    # Tải lại danh sách nguồn
+DAEMON_PUBLISH_INTERVAL = 60        # Gom thay đổi, publish tối đa mỗi phút
+DAEMON_MAX_STREAMS = 100000         # Trần số stream giữ trong bộ nhớ
+
+# SERVER (--serve): phục vụ playlist + shard từ bộ nhớ
+SERVE_HOST = "0.0.0.0"
+SERVE_PORT = 8080
+SERVE_MAX_AGE = 60           # Cache-Control max-age (giây)
+SERVE_RELOAD_INTERVAL = 30   # Kiểm tra file mới do lần chạy khác publish
+
+# BÁO CÁO TIẾN ĐỘ (giây giữa các dòng throughput)
+PROGRESS_INTERVAL = 10
+
+# PRE-PROBE: phân giải DNS hàng loạt + TCP connect sweep theo host:port trước mọi HTTP request
+PREPROBE_SWEEP = True
+PREPROBE_CONCURRENCY = 500
+PREPROBE_DNS_TIMEOUT = 3
+# Lookup chạy trong thread pool mặc định (ThreadedResolver, min(32, cpu+4) thread): giới hạn
+# số lookup đồng thời bằng đúng số thread để thời gian xếp hàng không bị tính là DNS timeout
+PREPROBE_DNS_CONCURRENCY = min(32, (os.cpu_count() or 1) + 4)
+PREPROBE_CONNECT_TIMEOUT = 2
+RESOLVER_CACHE_TTL = 600       # Giây giữ kết quả DNS (kể cả lỗi) trong resolver cache
+
+# DEADLINE: hết giờ thì dừng probe và publish các kênh đã xác minh (probe theo thứ tự giá trị kỳ vọng)
+PROBE_DEADLINE = 1500          # Giây kể từ lúc bắt đầu probe; None = không giới hạn
+DEFAULT_SOURCE_YIELD = 0.1     # Tỉ lệ kênh working giả định cho nguồn chưa có lịch sử
+
+# HEALTH CACHE: bỏ qua URL vừa kiểm tra gần đây (giữ giữa các lần chạy)
+CACHE_DIR = ".cache"
+HEALTH_CACHE_FILE = os.path.join(CACHE_DIR, "health.json")
+HEALTH_WORKING_TTL = 3 * 3600        # Tin kênh 'working' trong 3 giờ
+HEALTH_DEAD_BASE_TTL = 5 * 3600      # Kênh chết: chờ 5h, 10h, 20h... (exponential backoff)
+HEALTH_DEAD_MAX_TTL = 7 * 24 * 3600  # Tối đa 7 ngày giữa hai lần kiểm tra lại
+HEALTH_ENTRY_MAX_AGE = 14 * 24 * 3600  # Xoá entry không xuất hiện quá 14 ngày
+SOURCE_YIELD_FILE = os.path.join(CACHE_DIR, "source_yield.json")
+
+# SOURCE CACHE: ETag/Last-Modified + danh sách kênh đã parse của từng nguồn
+SOURCE_CACHE_DIR = os.path.join(CACHE_DIR, "sources")
+STREAM_CHUNK_SIZE = 64 * 1024  # Đọc body nguồn theo từng chunk 64KB
+SOURCE_CACHE_VERSION = 3       # Tăng khi đổi định dạng record trong cache
+
+# PARSE POOL: parse EXTINF + phân loại trên mọi core (0 = chạy ngay trên event loop)
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_BATCH_SIZE = 2000        # Số cặp EXTINF/URL mỗi lần gửi sang process con
+PARSE_MAX_PENDING = 4          # Số batch đang parse tối đa cho mỗi nguồn
 
 REQUEST_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
@@ -76,14 +188,355 @@ REQUEST_HEADERS = {
 }
 
 # LOGGING
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('iptv_generator.log', encoding='utf-8', mode='w')
-    ]
-)
+LOG_FILENAME = 'iptv_generator.log'
+
+def configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(LOG_FILENAME, encoding='utf-8', mode='w')
+        ]
+    )
+
+# =======================================================================================
+# METRICS (counters, gauges, histograms → JSON run report + Prometheus text file)
+# =======================================================================================
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (2**14, 2**16, 2**18, 2**20, 2**22, 2**24, 2**26)
+IN_FLIGHT_BUCKETS = (1, 5, 10, 25, 50, 100, 150, 200, 300)
+
+# name -> (type, help, buckets)
+METRIC_SPECS = {
+    'iptv_source_fetch_seconds': ('histogram', "Source download + parse time by source and result", SECONDS_BUCKETS),
+    'iptv_source_bytes': ('histogram', "Bytes downloaded per source fetch", BYTES_BUCKETS),
+    'iptv_source_channels_total': ('counter', "Channels per source at each stage (parsed, prefiltered, working, final)", None),
+    'iptv_parse_batch_seconds': ('histogram', "Time from submitting a parse batch to getting its records back", SECONDS_BUCKETS),
+    'iptv_parsed_records_total': ('counter', "Channel records produced by the parser", None),
+    'iptv_probe_seconds': ('histogram', "HTTP probe latency by outcome", SECONDS_BUCKETS),
+    'iptv_probe_failures_total': ('counter', "Dead channels by failure reason", None),
+    'iptv_probe_in_flight': ('histogram', "Probes already in flight when a new probe starts", IN_FLIGHT_BUCKETS),
+    'iptv_stage_seconds': ('gauge', "Wall time of each run stage", None),
+    'iptv_channels': ('gauge', "Channel counts of the last run (prefiltered, working, final)", None),
+}
+
+class Histogram:
+    __slots__ = ['bounds', 'counts', 'sum', 'count']
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Linear interpolation inside the bucket holding rank q (like histogram_quantile)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([*map(str, self.bounds), '+Inf'], self.counts)),
+        }
+
+class Metrics:
+    """In-process registry keyed by (metric name, sorted label pairs)"""
+    
+    def __init__(self):
+        self.values = {}
+
+    def _get(self, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        value = self.values.get(key)
+        if value is None:
+            kind, _, buckets = METRIC_SPECS[name]
+            value = self.values[key] = Histogram(buckets) if kind == 'histogram' else [0]
+        return value
+
+    def inc(self, name, amount=1, **labels):
+        self._get(name, labels)[0] += amount
+
+    def set(self, name, value, **labels):
+        self._get(name, labels)[0] = value
+
+    def observe(self, name, value, **labels):
+        self._get(name, labels).observe(value)
+
+    def series(self, name):
+        """[(labels dict, value)] of one metric"""
+        return [(dict(labels), value) for (key, labels), value in self.values.items() if key == name]
+
+    def as_dict(self):
+        result = defaultdict(list)
+        for (name, labels), value in sorted(self.values.items()):
+            result[name].append({
+                'labels': dict(labels),
+                **(value.as_dict() if isinstance(value, Histogram) else {'value': value[0]}),
+            })
+        return dict(result)
+
+    def to_prometheus(self):
+        lines = []
+        for name in sorted({name for name, _ in self.values}):
+            kind, help_text, _ = METRIC_SPECS[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(self.values.items()):
+                if metric != name:
+                    continue
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip([*map(str, value.bounds), '+Inf'], value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_prom_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_prom_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{_prom_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{_prom_labels(labels)} {value[0]}")
+        return '\n'.join(lines) + '\n'
+
+def _prom_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+METRICS = Metrics()
+
+def source_yield_report(metrics=METRICS):
+    """Per-source funnel parsed → prefiltered → working → final, plus fetch time and bytes"""
+    sources = defaultdict(lambda: {'parsed': 0, 'prefiltered': 0, 'working': 0, 'final': 0})
+    for labels, value in metrics.series('iptv_source_channels_total'):
+        sources[labels['source']][labels['stage']] += value[0]
+    for labels, histogram in metrics.series('iptv_source_fetch_seconds'):
+        entry = sources[labels['source']]
+        entry['fetch_seconds'] = round(entry.get('fetch_seconds', 0) + histogram.sum, 2)
+        entry['result'] = labels['result']
+    for labels, histogram in metrics.series('iptv_source_bytes'):
+        sources[labels['source']]['bytes'] = int(histogram.sum)
+    for entry in sources.values():
+        entry['yield'] = round(entry['final'] / entry['parsed'], 4) if entry['parsed'] else 0.0
+    return dict(sources)
+
+def write_run_report(started_at, json_path=RUN_REPORT_JSON, prom_path=METRICS_PROM, history_path=RUN_HISTORY):
+    """Write the JSON run report and the Prometheus text file, and append a line to the run history"""
+    sources = source_yield_report()
+    report = {
+        'started': started_at.strftime("%Y-%m-%d %H:%M:%S"),
+        'duration_s': round((datetime.now() - started_at).total_seconds(), 1),
+        'sources': sources,
+        'metrics': METRICS.as_dict(),
+    }
+    os.makedirs(os.path.dirname(json_path) or '.', exist_ok=True)
+    _write_atomic(json_path, json.dumps(report, ensure_ascii=False, indent=1))
+    _write_atomic(prom_path, METRICS.to_prometheus())
+    
+    # Một dòng gọn mỗi lần chạy để theo dõi phân bố latency theo thời gian
+    probe = {
+        labels['outcome']: {key: histogram.as_dict()[key] for key in ('count', 'p50', 'p95', 'p99')}
+        for labels, histogram in METRICS.series('iptv_probe_seconds')
+    }
+    stages = {labels['stage']: value[0] for labels, value in METRICS.series('iptv_stage_seconds')}
+    with open(history_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'started': report['started'], 'duration_s': report['duration_s'],
+                            'stages': stages, 'probe_seconds': probe}) + '\n')
+    
+    for source, entry in sorted(sources.items(), key=lambda item: item[1]['yield']):
+        logging.info(
+            f"Yield {entry['yield']:6.1%} | parsed {entry['parsed']:6d} → prefiltered {entry['prefiltered']:6d} → "
+            f"working {entry['working']:5d} → final {entry['final']:5d} | {source}"
+        )
+    logging.info(f"Run report: {json_path}, {prom_path}")
+
+# =======================================================================================
+# CLASSIFICATION ENGINE (biên dịch một lần khi import)
+# =======================================================================================
+
+COUNTRY_KEYWORDS = {
+    'usa': 'USA', 'us': 'USA', 'united states': 'USA',
+    'uk': 'UK', 'united kingdom': 'UK', 'britain': 'UK',
+    'canada': 'CA', 'canadian': 'CA',
+    'australia': 'AU', 'aussie': 'AU',
+    'france': 'FR', 'french': 'FR',
+    'germany': 'DE', 'german': 'DE',
+    'spain': 'ES', 'spanish': 'ES',
+    'italy': 'IT', 'italian': 'IT',
+    'netherlands': 'NL', 'dutch': 'NL',
+    'portugal': 'PT', 'portuguese': 'PT',
+}
+
+UHD_KEYWORDS = ['4k', 'uhd', '2160']
+FHD_KEYWORDS = ['1080', 'fhd', 'full hd', '1920']
+CODEC_KEYWORDS = ['hevc', 'h265', 'x265']
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_NAME_INVALID_RE = re.compile(r'[^\w\s\-\+\.\(\)\[\]&]')
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+_NAME_NOISE_RE = re.compile(r'\b(hd|fhd|uhd|4k|1080p|720p|sd|live|tv|channel)\b')
+_TVG_ID_RE = re.compile(r'[^\w-]')
+_EXTINF_PREFIX_RE = re.compile(r'^#EXTINF:-?\d+\s*')
+_EXTINF_ATTR_RE = re.compile(r'([\w-]+)=(["\'])([^\2]*?)\2')
+_EXTINF_ATTR_IN_NAME_RE = re.compile(r'[\w-]+=(["\'])[^\1]*\1')
+
+class ChannelClassifier:
+    """All country/blocklist/quality/codec keywords matched in one regex pass
+    
+    Matching keeps the original substring semantics: a zero-width lookahead finds
+    every start position, and each hit also carries the flags of the shorter
+    keywords that are its prefixes (e.g. 'india' implies 'in'), so no keyword is
+    shadowed. Name and group-title are scanned separately; the only matches that
+    can span both are keywords containing a space, handled by a suffix/prefix check.
+    """
+    
+    BLOCKED, UHD, FHD, LOW, CODEC = 1, 2, 4, 8, 16
+    MEMO_LIMIT = 200000
+    
+    def __init__(self):
+        flags = defaultdict(int)
+        for group, flag in ((BLOCKED_COUNTRIES, self.BLOCKED), (UHD_KEYWORDS, self.UHD),
+                            (FHD_KEYWORDS, self.FHD), (QUALITY_KEYWORDS_EXCLUDE, self.LOW),
+                            (CODEC_KEYWORDS, self.CODEC)):
+            for kw in group:
+                flags[kw] |= flag
+        
+        rank = {kw: i for i, kw in enumerate(COUNTRY_KEYWORDS)}
+        keywords = set(flags) | set(rank)
+        self.countries = list(COUNTRY_KEYWORDS.values()) + ['INT']
+        
+        # kw -> (flags, country rank) gộp cho chính nó và mọi keyword là tiền tố của nó
+        self.hits = {}
+        for kw in keywords:
+            implied = [k for k in keywords if kw.startswith(k)]
+            combined = 0
+            for k in implied:
+                combined |= flags.get(k, 0)
+            self.hits[kw] = (combined, min(rank.get(k, len(rank)) for k in implied))
+        
+        # Keyword có dấu cách có thể nằm vắt qua "name group": (phần trái, phần phải, flags)
+        self.straddles = [
+            (kw[:i], kw[i + 1:], flags.get(kw, 0))
+            for kw in keywords for i, ch in enumerate(kw) if ch == ' '
+        ]
+        self.straddle_lefts = tuple({left for left, _, _ in self.straddles})
+        
+        alternation = '|'.join(re.escape(kw) for kw in sorted(keywords, key=len, reverse=True))
+        self.findall = re.compile(f'(?=({alternation}))').findall
+        self.memo = {}
+
+    def classify(self, name, group, group_present=True):
+        """(country, quality_score) for a cleaned name and its effective group-title"""
+        key = (name, group, group_present)
+        result = self.memo.get(key)
+        if result is None:
+            if len(self.memo) >= self.MEMO_LIMIT:
+                self.memo.clear()
+            result = self.memo[key] = self._classify(name, group, group_present)
+        return result
+
+    def classify_many(self, items):
+        """Batch form of classify() for a whole parsed source: [(name, group, group_present)]"""
+        classify = self.classify
+        return [classify(name, group, present) for name, group, present in items]
+
+    def _classify(self, name, group, group_present):
+        hits = self.hits
+        name_lower = name.lower()
+        group_lower = group.lower()
+        
+        country_flags = 0
+        country_rank = len(self.countries) - 1
+        for kw in self.findall(name_lower):
+            flags, rank = hits[kw]
+            country_flags |= flags
+            if rank < country_rank:
+                country_rank = rank
+        
+        group_flags = 0
+        for kw in self.findall(group_lower):
+            flags, rank = hits[kw]
+            group_flags |= flags
+            # Quốc gia chỉ xét group-title gốc (không xét group mặc định từ category)
+            if group_present and rank < country_rank:
+                country_rank = rank
+        
+        any_flags = country_flags | group_flags
+        if group_present:
+            country_flags |= group_flags
+        
+        if self.straddle_lefts and name_lower.endswith(self.straddle_lefts):
+            for left, right, flags in self.straddles:
+                if name_lower.endswith(left) and group_lower.startswith(right):
+                    any_flags |= flags
+        
+        country = 'BLOCKED' if country_flags & self.BLOCKED else self.countries[country_rank]
+        
+        score = 50  # BASE SCORE: Giả định trung bình nếu không có thông tin
+        if any_flags & self.UHD:
+            score = 100
+        elif any_flags & self.FHD:
+            score = 80
+        if any_flags & self.LOW:
+            score = 0
+        if any_flags & self.CODEC:
+            score += 15
+        
+        return country, max(0, min(score, 115))
+
+CLASSIFIER = ChannelClassifier()
+
+# =======================================================================================
+# URL NORMALISATION
+# =======================================================================================
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def canonical_url(url):
+    """Normalised scheme/host/port/path/query used to probe each stream only once"""
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        host = f"[{host}]"
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        host = f"{userinfo}@{host}"
+    
+    path = parts.path or '/'
+    if '/.' in path or '//' in path:
+        normalized = posixpath.normpath(path)
+        path = normalized + '/' if path.endswith('/') and normalized != '/' else normalized
+    
+    query = '&'.join(sorted(p for p in parts.query.split('&') if p))
+    return f"{scheme}://{host}{path}?{query}" if query else f"{scheme}://{host}{path}"
 
 # =======================================================================================
 # ENHANCED CHANNEL CLASS WITH QUALITY DETECTION
@@ -93,7 +546,8 @@ class IPTVChannel:
     """Enhanced channel class with quality filtering"""
     
     __slots__ = ['name', 'url', 'attributes', 'category', 'status', 'ping', 
-                 'url_hash', 'name_normalized', 'country', 'quality_score']
+                 'url_hash', 'url_key', 'name_normalized', 'country', 'quality_score', 'stream_info',
+                 'timing', 'source', 'reason', 'fallbacks', 'row']
     
     def __init__(self, name, url, attributes, category):
         self.name = self._clean_name(name)
@@ -102,76 +556,33 @@ class IPTVChannel:
         self.category = category
         self.status = 'unchecked'
         self.ping = float('inf')
-        self.quality_score = 0
+        self.stream_info = None
+        self.timing = None
+        self.source = None
+        self.reason = None
+        self.fallbacks = None
+        self.row = None
         
         # Pre-compute hashes
         self.url_hash = hashlib.md5(url.encode()).hexdigest()[:16]
+        self.url_key = canonical_url(self.url)
         self.name_normalized = self._normalize_name(name)
-        self.country = self._extract_country()
         
+        group_present = 'group-title' in attributes
         self._ensure_required_attributes()
-        self._calculate_quality_score()
+        self.country, self.quality_score = CLASSIFIER.classify(
+            self.name, self.attributes['group-title'], group_present
+        )
 
     def _clean_name(self, name):
-        name = re.sub(r'\s+', ' ', name.strip())
-        name = re.sub(r'[^\w\s\-\+\.\(\)\[\]&]', '', name)
+        name = _WHITESPACE_RE.sub(' ', name.strip())
+        name = _NAME_INVALID_RE.sub('', name)
         return name[:80]
 
     def _normalize_name(self, name):
-        normalized = re.sub(r'[^\w\s]', '', name.lower())
-        normalized = re.sub(r'\b(hd|fhd|uhd|4k|1080p|720p|sd|live|tv|channel)\b', '', normalized)
-        return re.sub(r'\s+', ' ', normalized).strip()
-
-    def _extract_country(self):
-        """Enhanced country extraction with blocking"""
-        group = self.attributes.get('group-title', '').lower()
-        name_lower = self.name.lower()
-        
-        # CHECK BLOCKED COUNTRIES FIRST
-        for blocked in BLOCKED_COUNTRIES:
-            if blocked in group or blocked in name_lower:
-                return 'BLOCKED'
-        
-        # Country mapping
-        country_map = {
-            'usa': 'USA', 'us': 'USA', 'united states': 'USA',
-            'uk': 'UK', 'united kingdom': 'UK', 'britain': 'UK',
-            'canada': 'CA', 'canadian': 'CA',
-            'australia': 'AU', 'aussie': 'AU',
-            'france': 'FR', 'french': 'FR',
-            'germany': 'DE', 'german': 'DE',
-            'spain': 'ES', 'spanish': 'ES',
-            'italy': 'IT', 'italian': 'IT',
-            'netherlands': 'NL', 'dutch': 'NL',
-            'portugal': 'PT', 'portuguese': 'PT',
-        }
-        
-        for keyword, country in country_map.items():
-            if keyword in group or keyword in name_lower:
-                return country
-        
-        return 'INT'
-
-    def _calculate_quality_score(self):
-        """Calculate quality score based on resolution indicators"""
-        text = f"{self.name} {self.attributes.get('group-title', '')}".lower()
-        score = 50  # BASE SCORE: Giả định trung bình nếu không có thông tin
-        
-        # HIGH QUALITY INDICATORS (BONUS)
-        if any(kw in text for kw in ['4k', 'uhd', '2160']):
-            score = 100  # 4K/UHD - Chất lượng cao nhất
-        elif any(kw in text for kw in ['1080', 'fhd', 'full hd', '1920']):
-            score = 80   # 1080p/FHD - Chất lượng tốt
-        
-        # PENALTY FOR CLEARLY LOW QUALITY
-        if any(kw in text for kw in QUALITY_KEYWORDS_EXCLUDE):
-            score = 0  # Chắc chắn chất lượng thấp, loại bỏ
-        
-        # BONUS FOR HEVC/H265 (codec hiện đại)
-        if any(kw in text for kw in ['hevc', 'h265', 'x265']):
-            score += 15
-        
-        self.quality_score = max(0, min(score, 115))  # Giới hạn 0-115
+        normalized = _NON_WORD_RE.sub('', name.lower())
+        normalized = _NAME_NOISE_RE.sub('', normalized)
+        return _WHITESPACE_RE.sub(' ', normalized).strip()
 
     def is_high_quality(self):
         """Check if channel meets quality requirements"""
@@ -186,9 +597,59 @@ class IPTVChannel:
         # CHẤP NHẬN: Kênh có tag 1080p+ HOẶC không có tag gì (score=50)
         return True
 
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild a channel from to_record() output without re-running the parsers"""
+        channel = cls.__new__(cls)
+        (channel.name, channel.url, channel.category, tvg_id, tvg_name, group_title,
+         channel.url_hash, channel.url_key, channel.name_normalized, channel.country,
+         channel.quality_score) = record
+        channel.attributes = {'tvg-id': tvg_id, 'tvg-name': tvg_name, 'group-title': group_title}
+        channel.status = 'unchecked'
+        channel.ping = float('inf')
+        channel.stream_info = None
+        channel.timing = None
+        channel.source = None
+        channel.reason = None
+        channel.fallbacks = None
+        channel.row = None
+        return channel
+
+    @staticmethod
+    def record_is_high_quality(record):
+        """is_high_quality() on a to_record() tuple, without building the channel"""
+        country, quality_score = record[9], record[10]
+        return quality_score != 0 and country != 'BLOCKED'
+
+    def to_record(self):
+        """Compact tuple of everything derived at parse time (only the attributes that get written out)"""
+        return (self.name, self.url, self.category, self.attributes['tvg-id'],
+                self.attributes['tvg-name'], self.attributes['group-title'], self.url_hash,
+                self.url_key, self.name_normalized, self.country, self.quality_score)
+
+    def apply_stream_info(self, info):
+        """Replace the keyword guess with the resolution/codec read from the manifest"""
+        self.stream_info = info
+        height = effective_height(info)
+        if not height:
+            return
+        
+        if height >= 2160:
+            score = 100
+        elif height >= 1080:
+            score = 80
+        else:
+            score = 0  # Độ phân giải thật < 1080p: loại như tag chất lượng thấp
+        
+        codecs = (info.get('codecs') or '').lower()
+        if score and any(tag in codecs for tag in ('hvc1', 'hev1')):
+            score += 15
+        
+        self.quality_score = score
+
     def _ensure_required_attributes(self):
         if 'tvg-id' not in self.attributes:
-            self.attributes['tvg-id'] = re.sub(r'[^\w-]', '-', self.name.lower())[:40]
+            self.attributes['tvg-id'] = _TVG_ID_RE.sub('-', self.name.lower())[:40]
         if 'tvg-name' not in self.attributes:
             self.attributes['tvg-name'] = self.name
         if 'group-title' not in self.attributes:
@@ -208,41 +669,97 @@ class IPTVChannel:
 
 def parse_m3u_content(content, category):
     """Fast M3U parser"""
-    channels = []
+    return build_channels(parse_m3u_records(content), category)
+
+def parse_m3u_records(content):
+    """Split M3U text into raw (name, url, attributes) records"""
+    records = []
+    for extinf, url in parse_m3u_pairs(content):
+        try:
+            record = parse_extinf_record(extinf, url)
+        except:
+            continue
+        if record:
+            records.append(record)
+    return records
+
+def parse_m3u_pairs(content):
+    """Split M3U text into (EXTINF line, http URL) pairs"""
     content = content.replace('\r\n', '\n').replace('\r', '\n')
     if content.startswith('\ufeff'):
         content = content[1:]
     
-    lines = content.split('\n')
-    i = 0
+    parser = M3UStreamParser()
+    pairs = []
+    for line in content.split('\n'):
+        pairs.extend(parser.feed(line))
+    pairs.extend(parser.close())
+    return pairs
+
+class M3UStreamParser:
+    """Push parser: feed lines one at a time, get (extinf, url) pairs as soon as each one completes
+    
+    An EXTINF looks at most LOOKAHEAD following lines for its URL (comments and blank
+    lines are skipped); if none shows up, those lines are replayed as normal input.
+    """
+    
+    LOOKAHEAD = 4
     
-    while i < len(lines):
-        line = lines[i].strip()
+    def __init__(self):
+        self.extinf = None
+        self.window = []
+        self.saw_extinf = False
+
+    def feed(self, line):
+        stripped = line.strip()
         
-        if line.startswith('#EXTINF'):
-            url = None
-            for j in range(i + 1, min(i + 5, len(lines))):
-                next_line = lines[j].strip()
-                if next_line and not next_line.startswith('#'):
-                    url = next_line
-                    i = j
-                    break
-            
-            if url and url.startswith('http'):
-                try:
-                    channel = parse_extinf_line(line, url, category)
-                    if channel:
-                        channels.append(channel)
-                except:
-                    pass
+        if self.extinf is None:
+            if stripped.startswith('#EXTINF'):
+                self.extinf = stripped
+                self.saw_extinf = True
+            return []
         
-        i += 1
-    
-    return channels
+        if stripped and not stripped.startswith('#'):
+            extinf = self.extinf
+            self.extinf = None
+            self.window = []
+            return self._record(extinf, stripped)
+        
+        self.window.append(line)
+        if len(self.window) < self.LOOKAHEAD:
+            return []
+        return self._replay()
+
+    def close(self):
+        pairs = []
+        while self.extinf is not None:
+            pairs.extend(self._replay())
+        return pairs
+
+    def _replay(self):
+        lines = self.window
+        self.extinf = None
+        self.window = []
+        pairs = []
+        for line in lines:
+            pairs.extend(self.feed(line))
+        return pairs
+
+    @staticmethod
+    def _record(extinf, url):
+        return [(extinf, url)] if url.startswith('http') else []
 
 def parse_extinf_line(extinf_line, url, category):
     """Fast EXTINF parser"""
-    extinf_line = re.sub(r'^#EXTINF:-?\d+\s*', '', extinf_line)
+    record = parse_extinf_record(extinf_line, url)
+    if not record:
+        return None
+    
+    return IPTVChannel(*record, category)
+
+def parse_extinf_record(extinf_line, url):
+    """EXTINF line -> (name, url, attributes), or None if unusable"""
+    extinf_line = _EXTINF_PREFIX_RE.sub('', extinf_line)
     
     if ',' in extinf_line:
         attr_string, name = extinf_line.rsplit(',', 1)
@@ -251,271 +768,2800 @@ def parse_extinf_line(extinf_line, url, category):
         name = ''
     
     attributes = {}
-    for match in re.finditer(r'([\w-]+)=(["\'])([^\2]*?)\2', attr_string):
+    for match in _EXTINF_ATTR_RE.finditer(attr_string):
         key, _, value = match.groups()
         attributes[key] = value
     
     if not name:
         name = attributes.get('tvg-name', attributes.get('tvg-id', ''))
     
-    name = re.sub(r'[\w-]+=(["\'])[^\1]*\1', '', name).strip()
+    name = _EXTINF_ATTR_IN_NAME_RE.sub('', name).strip()
     
     if not name or len(name) < 2 or len(url) < 10:
         return None
     
-    return IPTVChannel(name, url, attributes, category)
+    return name, url, attributes
+
+# =======================================================================================
+# SOURCE CACHE
+# =======================================================================================
+
+class SourceCache:
+    """Raw body, HTTP validators and compact channel records of one source, kept in SOURCE_CACHE_DIR"""
+    
+    def __init__(self, url):
+        self.url = url
+        key = hashlib.md5(url.encode()).hexdigest()[:16]
+        self.body_path = os.path.join(SOURCE_CACHE_DIR, f"{key}.m3u")
+        self.meta_path = os.path.join(SOURCE_CACHE_DIR, f"{key}.json")
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.records = None
+        self.batches = None  # Số record của từng batch PARSE_BATCH_SIZE cặp, theo thứ tự trong body
+        self.saw_extinf = False
+        self.unchanged = False  # Body đang tải vẫn trùng từng byte với body đã cache
+        self._body = None
+        self._hasher = None
+        self._previous = None
+
+    def load(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return self
+        
+        if (meta.get('version') == SOURCE_CACHE_VERSION and meta.get('url') == self.url
+                and os.path.exists(self.body_path)):
+            self.etag = meta.get('etag')
+            self.last_modified = meta.get('last_modified')
+            self.content_hash = meta.get('content_hash')
+            self.records = meta.get('records')
+            self.batches = meta.get('batches')
+            # Chỉ phát lại theo batch được khi batch lần trước cắt cùng kích thước
+            self.unchanged = (self.records is not None and self.batches is not None
+                              and meta.get('batch_size') == PARSE_BATCH_SIZE)
+        return self
+
+    def conditional_headers(self):
+        headers = {}
+        if self.records is None:
+            return headers
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def open_spool(self):
+        """Create the spool file the body is downloaded into; returns a reader handle on it"""
+        os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+        self._body = open(f"{self.body_path}.tmp", 'wb')
+        self._hasher = hashlib.sha256()
+        return open(f"{self.body_path}.tmp", 'rb')
+
+    def write_chunk(self, chunk):
+        """Download side: append one chunk to the spool"""
+        self._body.write(chunk)
+        self._body.flush()
+        self._hasher.update(chunk)
+
+    def compare(self, chunk):
+        """Read side: is the body still byte-identical to the cached one up to and including `chunk`?"""
+        if not self.unchanged:
+            return False
+        # So với body cũ theo từng chunk: biết ngay khi nội dung bắt đầu khác (không cần chờ hash cuối)
+        try:
+            if self._previous is None:
+                self._previous = open(self.body_path, 'rb')
+            same = self._previous.read(len(chunk)) == chunk
+        except OSError:
+            same = False
+        if not same:
+            self._close_previous()
+        return same
+
+    def _close_previous(self):
+        self.unchanged = False
+        if self._previous is not None:
+            self._previous.close()
+            self._previous = None
+
+    def body_unchanged(self):
+        """After the last chunk: was the whole body identical to the cached one? (safe to call again)"""
+        if self._previous is not None:
+            self.unchanged = self._previous.read(1) == b''
+            self._previous.close()
+            self._previous = None
+        elif self._body is not None and self._body.tell() == 0:
+            self.unchanged = False  # Body rỗng
+        return self.unchanged
+
+    def discard_partial(self):
+        """Drop a body that was not committed by save() (error or invalid source)"""
+        self._close_previous()
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+            try:
+                os.remove(f"{self.body_path}.tmp")
+            except OSError:
+                pass
+
+    def save(self, response, records, batches=None):
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.records = records
+        if batches is not None:
+            self.batches = batches
+        
+        os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+            self.content_hash = self._hasher.hexdigest()
+            os.replace(f"{self.body_path}.tmp", self.body_path)
+        _write_atomic(self.meta_path, json.dumps({
+            'version': SOURCE_CACHE_VERSION,
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'content_hash': self.content_hash,
+            'batch_size': PARSE_BATCH_SIZE,
+            'batches': self.batches,
+            'records': self.records,
+        }, ensure_ascii=False, separators=(',', ':')))
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def build_channels(records, category):
+    channels = []
+    for name, url, attributes in records:
+        try:
+            channels.append(IPTVChannel(name, url, dict(attributes), category))
+        except:
+            pass
+    return channels
+
+# =======================================================================================
+# PARSE POOL (multi-core parsing + classification)
+# =======================================================================================
+
+_parse_pool = None
+
+def get_parse_pool():
+    """Lazily started ProcessPoolExecutor, or None when PARSE_WORKERS is 0"""
+    global _parse_pool
+    if _parse_pool is None and PARSE_WORKERS:
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _parse_pool
+
+def shutdown_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(cancel_futures=True)
+        _parse_pool = None
+
+def parse_record_batch(pairs, category):
+    """Worker side: (extinf, url) pairs -> compact channel records (plain tuples pickle cheaply)"""
+    records = []
+    for extinf, url in pairs:
+        try:
+            record = parse_extinf_record(extinf, url)
+            if record:
+                records.append(IPTVChannel(*record, category).to_record())
+        except:
+            pass
+    return records
+
+def parse_in_pool(pairs, category):
+    """Future of parse_record_batch, run in the pool (or inline when the pool is disabled)"""
+    loop = asyncio.get_event_loop()
+    pool = get_parse_pool()
+    started = time.perf_counter()
+    if pool is None:
+        future = loop.create_future()
+        future.set_result(parse_record_batch(pairs, category))
+    else:
+        future = loop.run_in_executor(pool, parse_record_batch, pairs, category)
+    future.add_done_callback(lambda f: _record_parse_batch(f, started))
+    return future
+
+def _record_parse_batch(future, started):
+    if future.cancelled() or future.exception() is not None:
+        return
+    METRICS.observe('iptv_parse_batch_seconds', time.perf_counter() - started)
+    METRICS.inc('iptv_parsed_records_total', len(future.result()))
 
 # =======================================================================================
 # FETCHING
 # =======================================================================================
 
-async def fetch_source(session, url, category, retry=0):
-    """Fast source fetching with minimal retries"""
+async def fetch_source(session, url, category):
+    """Fetch one source and return all of its channels"""
+    return [ch async for ch in iter_source_channels(session, url, category)]
+
+async def iter_source_channels(session, url, category):
+    """iter_source_records() as IPTVChannel objects tagged with their source"""
+    async for record in iter_source_records(session, url, category):
+        ch = IPTVChannel.from_record(record)
+        ch.source = url
+        yield ch
+
+async def iter_source_records(session, url, category, retry=0, started=None):
+    """Stream one source as compact records, yielded while the body is still downloading
+    
+    The event loop only splits lines into (extinf, url) pairs; EXTINF parsing and
+    classification run in the process pool in PARSE_BATCH_SIZE batches and come
+    back as compact records. A 304 (If-None-Match/If-Modified-Since) replays the
+    cached records without downloading or parsing anything. On a 200, every batch
+    whose bytes still match the cached body is replayed from the cached records
+    instead of being parsed, so an unchanged (or only appended-to) body costs no
+    parsing and at most one batch of pairs is held back at a time.
+    """
+    cache = SourceCache(url).load()
+    pending = deque()
+    records = None  # Khác None khi đã bắt đầu nhận body 200
+    started = started or time.perf_counter()
+    result = 'error'
     try:
         logging.info(f"Fetching: {url}")
         
         async with session.get(
             url,
+            headers=cache.conditional_headers(),
             timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
             allow_redirects=True
         ) as response:
+            if response.status == 304 and cache.records is not None:
+                result = 'not_modified'
+                METRICS.inc('iptv_source_channels_total', len(cache.records), source=url, stage='parsed')
+                logging.info(f"✓ {len(cache.records)} channels from {url} (not modified, cached)")
+                for record in cache.records:
+                    yield record
+                return
+            
             if response.status == 200:
-                content = await response.text(errors='ignore')
+                records = []
+                batches = []
+                batch = []
+                replay = deque(cache.batches) if cache.unchanged else deque()
+                replayed = 0
+                
+                def replay_batch():
+                    # Batch trùng từng byte với lần trước: dùng lại record cũ, bỏ qua parse + phân loại
+                    nonlocal replayed
+                    count = replay.popleft()
+                    chunk = cache.records[replayed:replayed + count]
+                    replayed += count
+                    batches.append(count)
+                    records.extend(chunk)
+                    return chunk
+                
+                async def drain(limit):
+                    while len(pending) > limit:
+                        parsed = await pending.popleft()
+                        batches.append(len(parsed))
+                        for record in parsed:
+                            records.append(record)
+                            yield record
+                
+                # cache.unchanged còn True nghĩa là mọi byte đã đọc (gồm cả batch vừa đủ) đều trùng bản cache
+                try:
+                    async for pair in iter_m3u_pairs(response, cache):
+                        batch.append(pair)
+                        if len(batch) < PARSE_BATCH_SIZE:
+                            continue
+                        if cache.unchanged and replay:
+                            for record in replay_batch():
+                                yield record
+                        else:
+                            pending.append(parse_in_pool(batch, category))
+                            async for record in drain(PARSE_MAX_PENDING):
+                                yield record
+                        batch = []
+                except (asyncio.TimeoutError, aiohttp.ClientPayloadError, aiohttp.ServerDisconnectedError):
+                    # Body đứt giữa chừng: vẫn phát các kênh đã nhận đủ, rồi mới báo nguồn bị cắt
+                    if batch:
+                        pending.append(parse_in_pool(batch, category))
+                    async for record in drain(0):
+                        yield record
+                    raise
+                
+                METRICS.observe('iptv_source_bytes', response.content.total_bytes, source=url)
+                unchanged = cache.body_unchanged()
+                if batch:
+                    if unchanged and replay:
+                        for record in replay_batch():
+                            yield record
+                    else:
+                        pending.append(parse_in_pool(batch, category))
+                async for record in drain(0):
+                    yield record
                 
-                if '#EXTINF' not in content:
+                if not records and not cache.saw_extinf:
+                    result = 'invalid'
                     logging.warning(f"Invalid M3U: {url}")
-                    return []
+                    return
                 
-                channels = parse_m3u_content(content, category)
-                logging.info(f"✓ {len(channels)} channels from {url}")
-                return channels
+                if unchanged:
+                    result = 'unchanged'
+                    METRICS.inc('iptv_source_channels_total', len(records), source=url, stage='parsed')
+                    cache.save(response, records, batches)
+                    logging.info(f"✓ {len(records)} channels from {url} (unchanged, cached)")
+                    return
+                
+                if replayed:
+                    logging.info(f"  {url}: {replayed} records reused from unchanged leading batches")
+                result = 'ok'
+                METRICS.inc('iptv_source_channels_total', len(records), source=url, stage='parsed')
+                cache.save(response, records, batches)
+                logging.info(f"✓ {len(records)} channels from {url}")
             else:
+                result = f'http_{response.status}'
                 logging.warning(f"HTTP {response.status}: {url}")
                 if retry < MAX_RETRIES:
+                    # Lần thử lại tự ghi thời gian tải (tính từ lần đầu) cùng kết quả cuối cùng
+                    result = None
                     await asyncio.sleep(1)
-                    return await fetch_source(session, url, category, retry + 1)
-                return []
+                    async for record in iter_source_records(session, url, category, retry + 1, started):
+                        yield record
                 
-    except asyncio.TimeoutError:
-        logging.error(f"Timeout: {url}")
-        return []
+    except (asyncio.TimeoutError, aiohttp.ClientPayloadError, aiohttp.ServerDisconnectedError) as e:
+        if records is not None:
+            # Body đứt giữa chừng: các kênh phía sau bị mất, báo rõ thay vì một dòng timeout chung chung
+            result = 'truncated'
+            logging.error(
+                f"Truncated: {url} - body stopped after {response.content.total_bytes} bytes "
+                f"({len(records)} channels delivered, {type(e).__name__}), remaining channels dropped"
+            )
+        elif isinstance(e, asyncio.TimeoutError):
+            result = 'timeout'
+            logging.error(f"Timeout: {url}")
+        else:
+            logging.error(f"Error: {url} - {str(e)[:50]}")
     except Exception as e:
         logging.error(f"Error: {url} - {str(e)[:50]}")
-        return []
-
-async def check_channel_status(session, channel, semaphore):
-    """Enhanced channel checking with strict ping requirements"""
-    async with semaphore:
-        start_time = asyncio.get_event_loop().time()
-        
-        try:
-            async with session.head(
-                channel.url,
-                timeout=aiohttp.ClientTimeout(total=CHANNEL_CHECK_TIMEOUT),
-                headers=REQUEST_HEADERS,
-                allow_redirects=True
-            ) as response:
-                end_time = asyncio.get_event_loop().time()
-                ping_ms = (end_time - start_time) * 1000
-                
-                # STRICT PING REQUIREMENT
-                if response.status in [200, 206, 301, 302, 303, 307, 308] and ping_ms <= MAX_ACCEPTABLE_PING_MS:
-                    channel.status = 'working'
-                    channel.ping = ping_ms
-                else:
-                    channel.status = 'dead'
-                    
-        except:
-            channel.status = 'dead'
-
-# =======================================================================================
-# ENHANCED FILTERING WITH QUALITY CHECKS
-# =======================================================================================
+    finally:
+        if result is not None:
+            METRICS.observe('iptv_source_fetch_seconds', time.perf_counter() - started, source=url, result=result)
+        cache.discard_partial()
+        # Batch còn dở khi nguồn lỗi: huỷ hoặc lấy exception để không bị cảnh báo
+        for future in pending:
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                future.exception()
 
-def filter_and_deduplicate(channels):
-    """Enhanced filtering with quality and ping requirements"""
-    logging.info(f"Starting quality filtering on {len(channels)} channels...")
-    
-    # STEP 1: Filter working channels
-    working = [ch for ch in channels if ch.status == 'working']
-    logging.info(f"Working channels: {len(working)}/{len(channels)}")
+async def spool_body(response, cache):
+    """Download the body into the cache spool at network speed and yield it back from disk
     
-    if not working:
-        return []
+    The download task never waits for the consumer: backpressure from the probe
+    pipeline only slows down reading the spool, so it can neither stall the socket
+    nor run out the fetch timeout. A download error is raised after every byte
+    received before it has been yielded.
+    """
+    reader = cache.open_spool()
+    progress = asyncio.Event()
     
-    # STEP 2: Filter by quality (loại bỏ kênh RÕ RÀNG chất lượng thấp hoặc bị chặn)
-    high_quality = [ch for ch in working if ch.is_high_quality()]
-    logging.info(f"After quality filter (removed low-quality tags & blocked countries): {len(high_quality)}/{len(working)}")
+    async def download():
+        try:
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                cache.write_chunk(chunk)
+                progress.set()
+        finally:
+            progress.set()
     
-    if not high_quality:
-        logging.warning("No channels passed quality filter!")
-        return []
+    task = asyncio.create_task(download())
+    try:
+        while True:
+            chunk = reader.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            if task.done():
+                task.result()
+                return
+            progress.clear()
+            await progress.wait()
+    finally:
+        reader.close()
+        if not task.done():
+            task.cancel()
+        # Lấy exception của task đã bị bỏ dở để không bị cảnh báo "never retrieved"
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+async def iter_m3u_pairs(response, cache):
+    """Decode the spooled body chunk by chunk (BOM and CRLF handled on the fly) into (extinf, url) pairs"""
+    try:
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='ignore')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    parser = M3UStreamParser()
+    pending = ''
+    first = True
     
-    # STEP 3: Filter by ping
-    fast_channels = [ch for ch in high_quality if ch.ping <= MAX_ACCEPTABLE_PING_MS]
-    logging.info(f"Fast enough (ping <= {MAX_ACCEPTABLE_PING_MS}ms): {len(fast_channels)}/{len(high_quality)}")
+    async for chunk in spool_body(response, cache):
+        cache.compare(chunk)
+        
+        text = pending + decoder.decode(chunk)
+        if first and text:
+            text = text.lstrip('\ufeff')
+            first = False
+        
+        # Giữ lại '\r' cuối chunk: có thể là nửa đầu của '\r\n'
+        if text.endswith('\r'):
+            text, carry = text[:-1], '\r'
+        else:
+            carry = ''
+        
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        pending = lines.pop() + carry
+        for line in lines:
+            for pair in parser.feed(line):
+                yield pair
     
-    if not fast_channels:
-        return []
+    # Hết body: chốt so sánh với bản cache trước khi phát các cặp cuối (body mới có thể chỉ là tiền tố của body cũ)
+    cache.body_unchanged()
     
-    # STEP 4: Deduplicate by URL (keep best ping)
-    url_map = {}
-    for ch in fast_channels:
-        if ch.url_hash not in url_map or ch.ping < url_map[ch.url_hash].ping:
-            url_map[ch.url_hash] = ch
-    
-    unique_urls = list(url_map.values())
-    logging.info(f"After URL deduplication: {len(unique_urls)}")
-    
-    # STEP 5: Deduplicate by name per country (ƯU TIÊN chất lượng cao hơn)
-    final_map = {}
-    for ch in unique_urls:
-        key = (ch.name_normalized, ch.country, ch.category)
-        if key not in final_map:
-            final_map[key] = ch
-        else:
-            existing = final_map[key]
-            # Ưu tiên: Chất lượng cao hơn → Ping thấp hơn
-            if (ch.quality_score > existing.quality_score or 
-                (ch.quality_score == existing.quality_score and ch.ping < existing.ping)):
-                final_map[key] = ch
+    tail = (pending + decoder.decode(b'', final=True)).replace('\r\n', '\n').replace('\r', '\n')
+    for line in tail.split('\n'):
+        for pair in parser.feed(line):
+            yield pair
+    for pair in parser.close():
+        yield pair
     
-    final = list(final_map.values())
+    cache.saw_extinf = parser.saw_extinf
+
+async def check_channel_status(session, channel, cache=None):
+    """Enhanced channel checking with strict ping requirements
     
-    # STEP 6: Sort by quality and ping
-    final.sort(key=lambda x: (x.category, -x.quality_score, x.ping))
+    Returns the probe outcome: 'cached', 'working', 'slow', 'rejected', 'timeout' or 'error';
+    a failed probe also leaves its specific cause in channel.reason (see failure_reason).
+    """
+    if cache is not None and cache.apply(channel):
+        return 'cached'
     
-    # Statistics
-    uhd_4k = len([ch for ch in final if ch.quality_score >= 100])
-    fhd_1080 = len([ch for ch in final if 80 <= ch.quality_score < 100])
-    unknown = len([ch for ch in final if ch.quality_score == 50])
-    enhanced = len([ch for ch in final if 50 < ch.quality_score < 80])
+    start_time = asyncio.get_event_loop().time()
+    timing = channel.timing = ProbeTiming()
     
-    logging.info(f"Final channels: {len(final)}")
-    logging.info(f"  └─ 4K/UHD: {uhd_4k} | 1080p: {fhd_1080} | Unknown quality: {unknown} | Enhanced: {enhanced}")
+    try:
+        async with session.head(
+            channel.url,
+            timeout=aiohttp.ClientTimeout(total=CHANNEL_CHECK_TIMEOUT),
+            headers=REQUEST_HEADERS,
+            allow_redirects=True,
+            trace_request_ctx=timing
+        ) as response:
+            end_time = asyncio.get_event_loop().time()
+            # Không tính thời gian chờ connection pool vào ping (nếu session có trace config)
+            ping_ms = timing.ranking_ms() if timing.ended is not None else (end_time - start_time) * 1000
+            
+            # STRICT PING REQUIREMENT
+            if response.status in [200, 206, 301, 302, 303, 307, 308] and ping_ms <= MAX_ACCEPTABLE_PING_MS:
+                channel.status = 'working'
+                channel.ping = ping_ms
+                channel.reason = None
+                outcome = 'working'
+            else:
+                channel.status = 'dead'
+                outcome = 'slow' if ping_ms > MAX_ACCEPTABLE_PING_MS else 'rejected'
+                channel.reason = 'slow' if outcome == 'slow' else f'http_{response.status}'
+                
+    except asyncio.TimeoutError:
+        channel.status = 'dead'
+        channel.reason = 'timeout'
+        outcome = 'timeout'
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        channel.status = 'dead'
+        channel.reason = failure_reason(e)
+        outcome = 'error'
     
-    excellent = len([ch for ch in final if ch.ping <= EXCELLENT_PING_MS])
-    good = len([ch for ch in final if EXCELLENT_PING_MS < ch.ping <= GOOD_PING_MS])
-    acceptable = len([ch for ch in final if ch.ping > GOOD_PING_MS])
+    # Probe thất bại vẫn được xuất timing (tới thời điểm lỗi/timeout)
+    if timing.started is not None and timing.ended is None:
+        timing.ended = asyncio.get_event_loop().time()
     
-    logging.info(f"Ping breakdown - Excellent: {excellent}, Good: {good}, Acceptable: {acceptable}")
+    if cache is not None:
+        cache.record(channel)
     
-    return final
+    return outcome
+
+def failure_reason(error):
+    """Short cause of a failed request: dns, refused, unreachable, connect, ssl, reset, redirects or error"""
+    if isinstance(error, aiohttp.ClientSSLError):
+        return 'ssl'
+    if isinstance(error, aiohttp.ClientConnectorError):
+        os_error = error.os_error
+        if isinstance(os_error, socket.gaierror):
+            return 'dns'
+        if isinstance(os_error, ConnectionRefusedError):
+            return 'refused'
+        if isinstance(os_error, OSError) and os_error.errno is not None:
+            return 'unreachable'
+        return 'connect'
+    if isinstance(error, socket.gaierror):
+        return 'dns'
+    if isinstance(error, ConnectionRefusedError):
+        return 'refused'
+    if isinstance(error, (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError)):
+        return 'reset'
+    if isinstance(error, aiohttp.TooManyRedirects):
+        return 'redirects'
+    return 'error'
 
 # =======================================================================================
-# OUTPUT GENERATION
+# PRE-PROBE SWEEP (bulk DNS + TCP connect)
 # =======================================================================================
 
-def generate_m3u_playlist(channels):
-    """Enhanced M3U generation with quality info"""
-    logging.info("Generating high-quality M3U playlist...")
-    
-    lines = [
-        '#EXTM3U',
-        f'#EXTINF:-1,Optimized Playlist - Updated: {datetime.now().strftime("%Y-%m-%d %H:%M UTC")}',
-        f'#EXTINF:-1,Total: {len(channels)} channels (Prioritized: 1080p+, Fast Ping, No Low Quality)',
-        ''
-    ]
+class CachingResolver(aiohttp.abc.AbstractResolver):
+    """aiohttp resolver that resolves each host once per RESOLVER_CACHE_TTL (failures included)
     
-    # Group by category
-    grouped = defaultdict(list)
-    for ch in channels:
-        grouped[ch.category].append(ch)
+    Concurrent lookups of the same host share one future, and the session's connector
+    uses the same instance, so the sweep's lookups are reused by the HTTP probes.
+    """
     
-    for category in sorted(grouped.keys()):
-        category_channels = grouped[category]
-        avg_ping = sum(ch.ping for ch in category_channels) / len(category_channels)
-        
-        lines.append(f'#EXTINF:-1,━━━ {category.upper()} ({len(category_channels)} channels, avg {avg_ping:.0f}ms) ━━━')
-        lines.append('')
+    def __init__(self, ttl=RESOLVER_CACHE_TTL):
+        self.ttl = ttl
+        self._base = aiohttp.DefaultResolver()
+        self._cache = {}
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        key = (host, family)
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached is None or now - cached[0] > self.ttl:
+            cached = self._cache[key] = (now, asyncio.ensure_future(self._base.resolve(host, 0, family)))
         
-        for ch in category_channels:
-            lines.append(ch.to_m3u_entry())
-            lines.append('')
+        entries = await asyncio.shield(cached[1])
+        return [{**entry, 'port': port} for entry in entries]
+
+    async def close(self):
+        await self._base.close()
+
+class EndpointSweep:
+    """Resolves and TCP-connects every unique host:port once, ahead of the HTTP probes
     
-    logging.info(f"Generated playlist with {len(channels)} optimized channels")
+    check() returns the reason ('dns', 'refused', 'unreachable') that marks every channel
+    behind the endpoint dead, or None to let the normal HTTP probe decide. Timeouts
+    ('dns_timeout', 'connect_timeout') are inconclusive: they are kept for the summary
+    but the channels still get their HTTP probe.
+    """
     
-    return '\n'.join(lines)
+    INCONCLUSIVE = frozenset({'dns_timeout', 'connect_timeout'})
+    
+    def __init__(self, resolver, concurrency=PREPROBE_CONCURRENCY, dns_concurrency=PREPROBE_DNS_CONCURRENCY):
+        self.resolver = resolver
+        self.results = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._resolving = asyncio.Semaphore(dns_concurrency)
+
+    @staticmethod
+    def endpoint(url):
+        try:
+            parts = urlsplit(url)
+            port = parts.port or DEFAULT_PORTS.get(parts.scheme.lower())
+        except ValueError:
+            return None
+        if not parts.hostname or not port:
+            return None
+        return parts.hostname.lower(), port
+
+    def prefetch(self, url):
+        """Start checking the URL's endpoint in the background (no-op if already known)"""
+        key = self.endpoint(url)
+        if key is None:
+            return None
+        task = self.results.get(key)
+        if task is None:
+            task = self.results[key] = asyncio.ensure_future(self._probe(*key))
+        return task
+
+    async def check(self, url):
+        task = self.prefetch(url)
+        if task is None:
+            return None
+        reason = await asyncio.shield(task)
+        return None if reason in self.INCONCLUSIVE else reason
+
+    async def _probe(self, host, port):
+        # Chỉ tính giờ khi đã có thread cho lookup, không tính thời gian chờ semaphore
+        async with self._resolving:
+            try:
+                infos = await asyncio.wait_for(self.resolver.resolve(host, port, socket.AF_UNSPEC),
+                                               PREPROBE_DNS_TIMEOUT)
+            except asyncio.TimeoutError:
+                return 'dns_timeout'
+            except OSError:
+                return 'dns'
+        if not infos:
+            return 'dns'
+        
+        async with self._semaphore:
+            # Thử lần lượt mọi địa chỉ (A/AAAA) như connector của aiohttp; chỉ chết khi tất cả đều lỗi
+            failures = set()
+            for address in dict.fromkeys(info['host'] for info in infos):
+                try:
+                    transport, _ = await asyncio.wait_for(
+                        asyncio.get_event_loop().create_connection(asyncio.Protocol, address, port),
+                        PREPROBE_CONNECT_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    failures.add('connect_timeout')
+                except ConnectionRefusedError:
+                    failures.add('refused')
+                except OSError:
+                    failures.add('unreachable')
+                else:
+                    transport.close()
+                    return None
+            # 'refused' nói rõ nhất: host còn sống nhưng cổng đóng
+            for reason in ('refused', 'connect_timeout', 'unreachable'):
+                if reason in failures:
+                    return reason
+
+    def summary(self):
+        counts = defaultdict(int)
+        for task in self.results.values():
+            if task.done() and not task.cancelled():
+                counts[task.result() or 'reachable'] += 1
+        return dict(counts)
+
+    def close(self):
+        for task in self.results.values():
+            task.cancel()
 
 # =======================================================================================
-# MAIN
+# PROBE TIMING (aiohttp TraceConfig)
 # =======================================================================================
 
-async def main():
-    """Main execution with enhanced quality filtering"""
-    start_time = datetime.now()
-    logging.info("=" * 60)
-    logging.info("IPTV GENERATOR - OPTIMIZED QUALITY MODE")
-    logging.info("Strategy: Prioritize 1080p+, Remove low-quality tags, Fast ping")
-    logging.info("=" * 60)
+class ProbeTiming:
+    """Per-phase timing of one probe, filled in by the trace hooks (seconds, loop clock)"""
     
-    all_channels = []
+    __slots__ = ['started', 'ended', 'queued', 'dns', 'connect', '_marks']
     
-    connector = aiohttp.TCPConnector(
-        limit=200,
-        limit_per_host=20,
-        ttl_dns_cache=600,
-        force_close=False,
-    )
+    def __init__(self):
+        self.started = None
+        self.ended = None
+        self.queued = 0.0
+        self.dns = 0.0
+        self.connect = 0.0
+        self._marks = {}
+
+    def mark(self, phase, now):
+        self._marks[phase] = now
+
+    def add(self, phase, now):
+        start = self._marks.pop(phase, None)
+        if start is not None:
+            setattr(self, phase, getattr(self, phase) + now - start)
+
+    def total_ms(self):
+        return (self.ended - self.started) * 1000
+
+    def ranking_ms(self):
+        """Total minus connection-pool wait: what the stream server and network cost"""
+        return (self.ended - self.started - self.queued) * 1000
+
+    def as_dict(self):
+        """queued/dns/connect(TCP+TLS)/ttfb/total in ms; ttfb is the remainder after setup"""
+        if self.started is None or self.ended is None:
+            return None
+        total = self.total_ms()
+        queued, dns, connect = self.queued * 1000, self.dns * 1000, self.connect * 1000
+        return {
+            'queued_ms': round(queued, 1),
+            'dns_ms': round(dns, 1),
+            'connect_ms': round(connect, 1),
+            'ttfb_ms': round(max(total - queued - dns - connect, 0.0), 1),
+            'total_ms': round(total, 1),
+        }
+
+def create_probe_trace_config():
+    """TraceConfig that records DNS, pool wait, connect and TTFB into trace_request_ctx"""
+    loop_time = lambda: asyncio.get_event_loop().time()
+    
+    def hook(action, phase=None):
+        async def callback(session, ctx, params):
+            timing = ctx.trace_request_ctx
+            if not isinstance(timing, ProbeTiming):
+                return
+            now = loop_time()
+            if action == 'start':
+                if timing.started is None:
+                    timing.started = now
+            elif action == 'end':
+                timing.ended = now
+            elif action == 'mark':
+                timing.mark(phase, now)
+            else:
+                timing.add(phase, now)
+        return callback
+    
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(hook('start'))
+    trace_config.on_request_end.append(hook('end'))
+    trace_config.on_connection_queued_start.append(hook('mark', 'queued'))
+    trace_config.on_connection_queued_end.append(hook('add', 'queued'))
+    trace_config.on_dns_resolvehost_start.append(hook('mark', 'dns'))
+    trace_config.on_dns_resolvehost_end.append(hook('add', 'dns'))
+    trace_config.on_connection_create_start.append(hook('mark', 'connect'))
+    trace_config.on_connection_create_end.append(hook('add', 'connect'))
+    return trace_config
+
+PROBE_TIMING_FIELDS = ['url_hash', 'name', 'category', 'host', 'status', 'reason', 'ping_ms',
+                       'queued_ms', 'dns_ms', 'connect_ms', 'ttfb_ms', 'total_ms']
+
+def export_probe_timings(channels, json_path=PROBE_TIMINGS_JSON, csv_path=PROBE_TIMINGS_CSV):
+    """Write the per-channel timing breakdown of every real probe as JSON and CSV"""
+    rows = []
+    for ch in channels:
+        breakdown = ch.timing.as_dict() if ch.timing else None
+        if not breakdown:
+            continue
+        rows.append({
+            'url_hash': ch.url_hash,
+            'name': ch.name,
+            'category': ch.category,
+            'host': urlsplit(ch.url).netloc,
+            'status': ch.status,
+            'reason': ch.reason,
+            'ping_ms': round(ch.ping, 1) if ch.ping != float('inf') else None,
+            **breakdown,
+        })
+    
+    for path in (json_path, csv_path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    _write_atomic(json_path, json.dumps(rows, ensure_ascii=False, indent=1))
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PROBE_TIMING_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    
+    if rows:
+        medians = {
+            field: statistics.median(row[field] for row in rows)
+            for field in ('queued_ms', 'dns_ms', 'connect_ms', 'ttfb_ms', 'total_ms')
+        }
+        logging.info(
+            f"Probe time (median of {len(rows)}): queued {medians['queued_ms']:.0f}ms | "
+            f"dns {medians['dns_ms']:.0f}ms | connect+tls {medians['connect_ms']:.0f}ms | "
+            f"ttfb {medians['ttfb_ms']:.0f}ms | total {medians['total_ms']:.0f}ms"
+        )
+    logging.info(f"Probe timings exported: {json_path}, {csv_path}")
+
+# =======================================================================================
+# HEALTH CACHE
+# =======================================================================================
+
+class HealthCache:
+    """On-disk probe history keyed by url_hash: [status, ping, checked_at, failures, stream_info | reason]"""
+    
+    def __init__(self, path=HEALTH_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        self.trusted_working = 0
+        self.skipped_dead = 0
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            logging.info(f"Health cache: {len(self.entries)} entries loaded from {self.path}")
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Health cache unreadable, starting fresh: {str(e)[:50]}")
+            self.entries = {}
+        return self
+
+    def save(self):
+        now = time.time()
+        self.entries = {
+            key: entry for key, entry in self.entries.items()
+            if now - entry[2] <= HEALTH_ENTRY_MAX_AGE
+        }
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        _write_atomic(self.path, json.dumps(self.entries, separators=(',', ':')))
+
+    @staticmethod
+    def dead_ttl(failures):
+        """Backoff window for a URL that failed `failures` times in a row"""
+        return min(HEALTH_DEAD_BASE_TTL * 2 ** max(failures - 1, 0), HEALTH_DEAD_MAX_TTL)
+
+    def is_fresh(self, entry, now=None):
+        """True when `entry` is recent enough to be reused instead of probing"""
+        status, _, checked_at, failures = entry[:4]
+        age = (now or time.time()) - checked_at
+        if status == 'working':
+            return age <= HEALTH_WORKING_TTL
+        return age <= self.dead_ttl(failures)
+
+    def fresh_entry(self, url_hash, now=None):
+        """The cached entry for `url_hash` if it can still be reused, else None"""
+        entry = self.entries.get(url_hash)
+        if entry and self.is_fresh(entry, now):
+            return entry
+        return None
+
+    def apply(self, channel, now=None):
+        """Reuse a fresh cached verdict; returns False when the URL must be probed"""
+        entry = self.fresh_entry(channel.url_hash, now)
+        if entry is None:
+            return False
+        
+        status, ping = entry[:2]
+        if status == 'working':
+            channel.status = 'working'
+            channel.ping = ping
+            if len(entry) > 4 and entry[4] is not None:
+                channel.apply_stream_info(entry[4])
+            self.trusted_working += 1
+            return True
+        
+        channel.status = 'dead'
+        channel.reason = entry[4] if len(entry) > 4 else None
+        self.skipped_dead += 1
+        return True
+
+    def record(self, channel, now=None):
+        entry = self.entries.get(channel.url_hash)
+        failures = entry[3] if entry else 0
+        
+        if channel.status == 'working':
+            self.entries[channel.url_hash] = [
+                'working', round(channel.ping, 1), now or time.time(), 0, channel.stream_info
+            ]
+        else:
+            self.entries[channel.url_hash] = ['dead', None, now or time.time(), failures + 1, channel.reason]
+
+    def record_group(self, channels, now=None):
+        """Record one probe result shared by several channels, once per url_hash
+        
+        Copies of the same URL in several sources share a url_hash; recording each
+        copy would count one failed probe several times and inflate the backoff.
+        """
+        recorded = set()
+        for channel in channels:
+            if channel.url_hash not in recorded:
+                recorded.add(channel.url_hash)
+                self.record(channel, now)
+
+class SourceYield:
+    """Share of each source's probed channels that turned out working, smoothed across runs"""
+    
+    def __init__(self, path=SOURCE_YIELD_FILE):
+        self.path = path
+        self.rates = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.rates = json.load(f)
+        except (OSError, ValueError):
+            self.rates = {}
+        return self
+
+    def update(self, outcomes):
+        """Blend this run's yields in; `outcomes` are (source, status) pairs, one per channel"""
+        probed = defaultdict(int)
+        working = defaultdict(int)
+        for source, status in outcomes:
+            if source is None or status == 'unchecked':
+                continue
+            probed[source] += 1
+            working[source] += status == 'working'
+        
+        for source, count in probed.items():
+            rate = working[source] / count
+            old = self.rates.get(source)
+            self.rates[source] = round(rate if old is None else 0.5 * old + 0.5 * rate, 4)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        _write_atomic(self.path, json.dumps(self.rates, indent=1))
+
+# =======================================================================================
+# HEALTH-CHECK SCHEDULER
+# =======================================================================================
+
+class HostState:
+    """AIMD concurrency window and timeout streak for one origin"""
+    
+    __slots__ = ['origin', 'limit', 'in_flight', 'parked', 'timeouts_in_row', 'answered', 'down',
+                 'decreased_at', 'probed', 'working']
+    
+    def __init__(self, origin):
+        self.origin = origin
+        self.limit = float(HOST_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.parked = deque()
+        self.timeouts_in_row = 0
+        self.answered = False
+        self.down = False
+        self.decreased_at = float('-inf')
+        self.probed = 0
+        self.working = 0
+
+    @property
+    def capacity(self):
+        return max(1, int(self.limit))
+
+    def observe(self, outcome, ping_ms, now):
+        """Additive increase on fast answers, multiplicative decrease on timeouts/errors"""
+        self.probed += 1
+        self.working += outcome == 'working'
+        if outcome in ('timeout', 'error'):
+            # Giảm tối đa một lần mỗi cửa sổ timeout (các probe cùng đợt không bị tính chồng)
+            if now - self.decreased_at >= CHANNEL_CHECK_TIMEOUT:
+                self.limit = max(1.0, self.limit / 2)
+                self.decreased_at = now
+            if outcome == 'timeout':
+                self.timeouts_in_row += 1
+                # Chỉ short-circuit host chưa từng trả lời trong lần chạy này
+                if not self.answered and self.timeouts_in_row >= HOST_FAILFAST_TIMEOUTS:
+                    self.down = True
+            return
+        
+        self.timeouts_in_row = 0
+        self.answered = True
+        if outcome == 'working' and ping_ms > HOST_TARGET_LATENCY_MS or outcome == 'slow':
+            self.limit = max(1.0, self.limit * 0.75)
+        else:
+            self.limit = min(float(HOST_MAX_CONCURRENCY), self.limit + 1 / self.limit)
+
+class ProbeIndex:
+    """Canonical URL -> channels sharing it; only the first one is probed, the rest copy its result"""
+    
+    def __init__(self):
+        self.groups = {}
+        self.channels = 0
+
+    def add(self, channel):
+        """Register a channel; returns True when its stream still needs a probe"""
+        self.channels += 1
+        group = self.groups.get(channel.url_key)
+        if group is None:
+            self.groups[channel.url_key] = [channel]
+            return True
+        
+        group.append(channel)
+        if group[0].status != 'unchecked':
+            self._copy(group[0], channel)
+        return False
+
+    def fan_out(self, probed):
+        """Copy a finished probe to every channel that references the same stream"""
+        followers = self.groups.get(probed.url_key, ())
+        for ch in followers[1:]:
+            self._copy(probed, ch)
+        return followers[1:]
+
+    @staticmethod
+    def _copy(source, target):
+        target.status = source.status
+        target.ping = source.ping
+        target.reason = source.reason
+        if source.stream_info is not None:
+            target.apply_stream_info(source.stream_info)
+
+    def heads(self, status):
+        """The probed channel of every stream whose verdict is `status`"""
+        for group in self.groups.values():
+            if group[0].status == status:
+                yield group[0]
+
+    @property
+    def probes_saved(self):
+        return self.channels - len(self.groups)
+
+class RowIndex:
+    """ProbeIndex over ChannelTable rows, so the catalogue never exists as IPTVChannel objects
+    
+    Rows are registered at ingest. Only the first row of each canonical URL is
+    materialised, for as long as its probe runs; when it finishes, the verdict is
+    written into that row and every other row referencing the same stream.
+    """
+    
+    def __init__(self, table):
+        self.table = table
+        self.groups = {}     # url_key -> row đầu tiên (row được probe)
+        self.followers = {}  # url_key -> các row khác cùng stream (thưa)
+        self.channels = 0
+
+    def add_row(self, row):
+        """Register a table row; returns True when its stream still needs a probe"""
+        self.channels += 1
+        key = self.table.url_keys[row]
+        head = self.groups.get(key)
+        if head is None:
+            self.groups[key] = row
+            return True
+        
+        self.followers.setdefault(key, []).append(row)
+        if self.table.status[head] != self.table.unchecked:
+            self.table.copy_result(head, row)
+        return False
+
+    def add(self, channel):
+        # Row đã được add_row() đăng ký lúc nạp; scheduler chỉ hỏi lại trước khi xếp hàng
+        return self.groups.get(channel.url_key) == channel.row
+
+    def fan_out(self, probed):
+        """Store a finished probe in its row and copy it to the other rows of the stream
+        
+        Returns the followers as short-lived channels so the health cache can record
+        their url_hashes too.
+        """
+        table = self.table
+        table.store(probed.row, probed)
+        followers = []
+        for row in self.followers.get(probed.url_key, ()):
+            table.copy_result(probed.row, row)
+            followers.append(table.channel(row))
+        return followers
+
+    def heads(self, status):
+        table = self.table
+        code = table.statuses.codes.get(status)
+        for row in self.groups.values():
+            if table.status[row] == code:
+                yield table.channel(row)
+
+    @property
+    def probes_saved(self):
+        return self.channels - len(self.groups)
+
+def channel_origin(url):
+    parsed = urlparse(url)
+    return f"{parsed.scheme.lower()}://{parsed.netloc.lower()}"
+
+class ProbeScheduler:
+    """Fixed pool of workers fed from a priority queue so every probe slot stays busy
+    
+    Probes are grouped by origin: each host gets its own AIMD concurrency window,
+    channels over the window wait in that host's parking deque, and a host that
+    never answered and timed out HOST_FAILFAST_TIMEOUTS times in a row fails its
+    remaining URLs fast. The queue is ordered by expected value (see priority()),
+    and once `deadline` seconds have passed the remaining probes are abandoned.
+    """
+    
+    def __init__(self, session, cache=None, workers=MAX_CONCURRENT_CHECKS, backlog=None, on_result=None,
+                 source_yield=None, deadline=None, sweep=None, index=None):
+        self.session = session
+        self.sweep = sweep
+        self.cache = cache
+        self.on_result = on_result
+        self.source_yield = source_yield or {}
+        self.deadline = deadline
+        self.deadline_at = None
+        self.expired = False
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()
+        self.hosts = {}
+        self.total = 0
+        self.checked = 0
+        self.working = 0
+        self.failed_fast = 0
+        self.unreachable = 0
+        self.in_flight = 0
+        self.started_at = None
+        self.index = index if index is not None else ProbeIndex()
+        self._seq = 0
+        self._tasks = []
+        # Giới hạn số kênh đang nằm trong scheduler (queue + parked + in-flight) khi nạp dạng stream
+        self._backlog = asyncio.Semaphore(backlog) if backlog else None
+
+    async def run(self, channels):
+        """Probe every channel and return once the queue is drained"""
+        unique = [ch for ch in channels if self.index.add(ch)]
+        if not unique:
+            return
+        
+        self.start(min(self.workers, len(unique)))
+        for ch in unique:
+            self._prefetch(ch)
+        for ch in self._interleave_by_host(unique):
+            self._put(ch)
+        self.total += len(unique)
+        await self.drain()
+
+    def start(self, workers=None):
+        self.started_at = asyncio.get_event_loop().time()
+        if self.deadline is not None:
+            self.deadline_at = self.started_at + self.deadline
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(workers or self.workers)]
+        self._tasks.append(asyncio.create_task(self._report_progress()))
+
+    async def submit(self, channel):
+        """Queue one channel while the pool is running; waits when the backlog is full"""
+        if not self.index.add(channel):
+            return
+        self._prefetch(channel)
+        if self._backlog is not None:
+            await self._backlog.acquire()
+        self.total += 1
+        self._put(channel)
+
+    def _prefetch(self, channel):
+        """Start the endpoint sweep early, except for channels a fresh cached verdict will answer"""
+        if self.sweep is None:
+            return
+        if (channel.status == 'unchecked' and self.cache is not None
+                and self.cache.fresh_entry(channel.url_hash) is not None):
+            return
+        self.sweep.prefetch(channel.url)
+
+    def recheck(self, channel):
+        """Queue a fresh probe of a stream that is already indexed (its cached verdict is ignored)"""
+        self.total += 1
+        self._put(channel)
+
+    def priority(self, channel):
+        """Expected value of probing `channel`: P(working) x quality_score
+        
+        P(working) starts from the source's historical yield, is raised or lowered by
+        the URL's own history in the health cache and blended with how the host has
+        answered so far in this run. Fresh cached verdicts cost nothing and go first.
+        """
+        p = self.source_yield.get(channel.source, DEFAULT_SOURCE_YIELD)
+        
+        entry = self.cache.entries.get(channel.url_hash) if self.cache is not None else None
+        if entry:
+            if channel.status == 'unchecked' and self.cache.is_fresh(entry):
+                return float('inf')
+            if entry[0] == 'working':
+                p = max(p, 0.8)
+            else:
+                p *= 0.5 ** entry[3]
+        
+        host = self.hosts.get(channel_origin(channel.url))
+        if host is not None:
+            if host.down:
+                return 0.0
+            if host.probed >= 3:
+                p = (p + host.working / host.probed) / 2
+        
+        return p * max(channel.quality_score, 1)
+
+    def _put(self, channel):
+        self._seq += 1
+        self.queue.put_nowait((-self.priority(channel), self._seq, channel))
+
+    def time_left(self):
+        """Seconds until the deadline (None when there is none)"""
+        if self.deadline_at is None:
+            return None
+        return max(0.0, self.deadline_at - asyncio.get_event_loop().time())
+
+    async def drain(self):
+        """Wait for every submitted channel (or the deadline), then stop the workers"""
+        try:
+            await asyncio.wait_for(self.queue.join(), self.time_left())
+        except asyncio.TimeoutError:
+            if self.checked < self.total:
+                self.expired = True
+                logging.warning(
+                    f"Probe deadline ({self.deadline}s) reached: {self.total - self.checked} streams "
+                    f"left unchecked, publishing the channels verified so far"
+                )
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+            if self.sweep is not None:
+                self.sweep.close()
+        
+        self._log_progress()
+        down = sum(1 for host in self.hosts.values() if host.down)
+        logging.info(f"Hosts: {len(self.hosts)} | short-circuited: {down} | fast-failed URLs: {self.failed_fast}")
+        if self.sweep is not None:
+            summary = ', '.join(f"{reason} {count}" for reason, count in sorted(self.sweep.summary().items()))
+            logging.info(f"Pre-probe sweep: {len(self.sweep.results)} endpoints ({summary}) | "
+                         f"URLs dead before HTTP: {self.unreachable}")
+        logging.info(
+            f"Unique streams: {len(self.index.groups)} for {self.index.channels} channels "
+            f"(saved {self.index.probes_saved} duplicate probes)"
+        )
+
+    def _interleave_by_host(self, channels):
+        """Round-robin over origins so one big host does not monopolise the queue head"""
+        groups = defaultdict(deque)
+        for ch in channels:
+            groups[channel_origin(ch.url)].append(ch)
+        
+        pending = deque(groups.values())
+        while pending:
+            group = pending.popleft()
+            yield group.popleft()
+            if group:
+                pending.append(group)
+
+    async def _worker(self):
+        while True:
+            _, _, channel = await self.queue.get()
+            try:
+                await self._dispatch(channel)
+            finally:
+                self.queue.task_done()
+
+    async def _dispatch(self, channel):
+        origin = channel_origin(channel.url)
+        host = self.hosts.get(origin)
+        if host is None:
+            host = self.hosts[origin] = HostState(origin)
+        
+        # Verdict lấy từ cache hoặc do host sập không phải kết quả probe URL này: không ghi lại,
+        # nếu không mỗi lần bỏ qua sẽ làm mới checked_at và cộng failures mà URL chưa hề được thử
+        if channel.status == 'unchecked' and self.cache is not None and self.cache.apply(channel):
+            self._finish(channel, record=False)
+            self._release(host)
+            return
+        
+        if host.down:
+            channel.status = 'dead'
+            channel.reason = channel.reason or 'host_down'
+            self.failed_fast += 1
+            self._finish(channel, record=False)
+            self._release(host)
+            return
+        
+        if self.sweep is not None:
+            reason = await self.sweep.check(channel.url)
+            if reason is not None:
+                channel.status = 'dead'
+                channel.reason = reason
+                self.unreachable += 1
+                self._finish(channel)
+                self._release(host)
+                return
+        
+        if host.in_flight >= host.capacity:
+            host.parked.append(channel)
+            return
+        
+        METRICS.observe('iptv_probe_in_flight', self.in_flight)
+        host.in_flight += 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            outcome = await check_channel_status(self.session, channel)
+        finally:
+            host.in_flight -= 1
+            self.in_flight -= 1
+        METRICS.observe('iptv_probe_seconds', time.perf_counter() - started, outcome=outcome)
+        
+        host.observe(outcome, channel.ping, asyncio.get_event_loop().time())
+        self._finish(channel)
+        self._release(host)
+
+    def _release(self, host):
+        """Move parked channels back to the queue for every free slot (all of them once the host is down)"""
+        free = len(host.parked) if host.down else host.capacity - host.in_flight
+        for _ in range(min(free, len(host.parked))):
+            self._put(host.parked.popleft())
+
+    def _finish(self, channel, record=True):
+        followers = self.index.fan_out(channel)
+        if record and self.cache is not None:
+            self.cache.record_group([channel, *followers])
+        if self._backlog is not None:
+            self._backlog.release()
+        self.checked += 1
+        if channel.status == 'working':
+            self.working += 1
+        if self.on_result is not None:
+            self.on_result(channel)
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            self._log_progress()
+
+    def _log_progress(self):
+        elapsed = asyncio.get_event_loop().time() - self.started_at
+        rate = self.checked / elapsed if elapsed > 0 else 0.0
+        parked = sum(len(host.parked) for host in self.hosts.values())
+        logging.info(
+            f"Checked {self.checked}/{self.total} | {rate:.1f} checks/s | "
+            f"in-flight: {self.in_flight} | queue: {self.queue.qsize()} | parked: {parked} | working: {self.working}"
+        )
+
+# =======================================================================================
+# DEEP STREAM VALIDATION (HLS/DASH)
+# =======================================================================================
+
+_HLS_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_DASH_REPRESENTATION_RE = re.compile(r'<(?:\w+:)?Representation\b([^>]*)>')
+_XML_ATTR_RE = re.compile(r'([\w:-]+)="([^"]*)"')
+
+def is_manifest_url(url):
+    path = urlsplit(url).path.lower()
+    return path.endswith('.m3u8') or path.endswith('.mpd')
+
+def parse_hls_manifest(text, base_url):
+    """{'variants': [...], 'segment': url} for an HLS playlist, or None if it is not one"""
+    lines = [line.strip() for line in text.lstrip('\ufeff').splitlines()]
+    if not lines or not lines[0].startswith('#EXTM3U'):
+        return None
+    
+    variants = []
+    segment = None
+    stream_inf = None
+    for line in lines[1:]:
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            stream_inf = {
+                key: value.strip('"')
+                for key, value in _HLS_ATTR_RE.findall(line.split(':', 1)[1])
+            }
+        elif line and not line.startswith('#'):
+            if stream_inf is not None:
+                width, _, height = stream_inf.get('RESOLUTION', '').partition('x')
+                variants.append({
+                    'width': int(width) if width.isdigit() else None,
+                    'height': int(height) if height.isdigit() else None,
+                    'bandwidth': int(stream_inf['BANDWIDTH']) if stream_inf.get('BANDWIDTH', '').isdigit() else None,
+                    'codecs': stream_inf.get('CODECS'),
+                    'uri': urljoin(base_url, line),
+                })
+                stream_inf = None
+            elif segment is None:
+                segment = urljoin(base_url, line)
+    
+    return {'variants': variants, 'segment': segment}
+
+def parse_dash_manifest(text):
+    """{'variants': [...], 'segment': None} from the Representation elements of an MPD"""
+    if '<MPD' not in text and ':MPD' not in text:
+        return None
+    
+    variants = []
+    for attr_string in _DASH_REPRESENTATION_RE.findall(text):
+        attrs = dict(_XML_ATTR_RE.findall(attr_string))
+        variants.append({
+            'width': int(attrs['width']) if attrs.get('width', '').isdigit() else None,
+            'height': int(attrs['height']) if attrs.get('height', '').isdigit() else None,
+            'bandwidth': int(attrs['bandwidth']) if attrs.get('bandwidth', '').isdigit() else None,
+            'codecs': attrs.get('codecs'),
+            'uri': None,
+        })
+    return {'variants': variants, 'segment': None}
+
+def effective_height(info):
+    """Height of the 16:9 frame a stream fills, so letterboxed encodes count by their width
+    
+    A 1920x800 (2.40:1) film encode is Full HD even though its height is below
+    1080 - the same as the name classifier treating '1920' as FHD.
+    """
+    if not info:
+        return None
+    height = info.get('height') or 0
+    width = info.get('width') or 0
+    return max(height, width * 9 // 16) or None
+
+def best_variant(variants):
+    """Highest resolution first, then highest bandwidth"""
+    if not variants:
+        return None
+    return max(variants, key=lambda v: (effective_height(v) or 0, v['bandwidth'] or 0))
+
+async def fetch_limited(session, url, limit, headers=None):
+    """GET at most `limit` bytes; returns (status, body, final_url, ttfb_ms, elapsed_ms)"""
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    async with session.get(
+        url,
+        headers={**REQUEST_HEADERS, **(headers or {})},
+        timeout=aiohttp.ClientTimeout(total=DEEP_VALIDATION_TIMEOUT),
+        allow_redirects=True
+    ) as response:
+        ttfb_ms = (loop.time() - start) * 1000
+        body = bytearray()
+        if response.status in (200, 206):
+            async for chunk in response.content.iter_chunked(16 * 1024):
+                body.extend(chunk[:limit - len(body)])
+                if len(body) >= limit:
+                    break
+        elapsed_ms = (loop.time() - start) * 1000
+        return response.status, bytes(body), str(response.url), ttfb_ms, elapsed_ms
+
+async def validate_stream(session, url):
+    """Second-tier check of a manifest URL that already passed HEAD
+    
+    Returns (verdict, info): verdict is 'working', 'dead' or 'inconclusive';
+    info holds height/width/bandwidth/codecs and, with SEGMENT_PROBE, the
+    first segment's ttfb_ms and kbps.
+    """
+    try:
+        status, body, final_url, _, _ = await fetch_limited(session, url, MANIFEST_MAX_BYTES)
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        return 'inconclusive', None
+    
+    if status not in (200, 206):
+        return 'dead', None
+    
+    text = body.decode('utf-8', errors='ignore')
+    if urlsplit(url).path.lower().endswith('.mpd'):
+        manifest = parse_dash_manifest(text)
+    else:
+        manifest = parse_hls_manifest(text, final_url)
+    
+    if manifest is None or not (manifest['variants'] or manifest['segment']):
+        return 'dead', None
+    
+    variant = best_variant(manifest['variants'])
+    info = {key: variant[key] for key in ('width', 'height', 'bandwidth', 'codecs')} if variant else {}
+    
+    if SEGMENT_PROBE:
+        segment = manifest['segment']
+        try:
+            if segment is None and variant and variant['uri']:
+                _, media_body, media_url, _, _ = await fetch_limited(session, variant['uri'], MANIFEST_MAX_BYTES)
+                media = parse_hls_manifest(media_body.decode('utf-8', errors='ignore'), media_url)
+                segment = media['segment'] if media else None
+            
+            if segment:
+                seg_status, seg_body, _, ttfb_ms, elapsed_ms = await fetch_limited(
+                    session, segment, SEGMENT_PROBE_BYTES,
+                    headers={'Range': f"bytes=0-{SEGMENT_PROBE_BYTES - 1}"}
+                )
+                if seg_status not in (200, 206):
+                    return 'dead', info
+                transfer_ms = max(elapsed_ms - ttfb_ms, 1.0)
+                info['ttfb_ms'] = round(ttfb_ms, 1)
+                info['kbps'] = round(len(seg_body) * 8 / transfer_ms, 1)
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            pass
+    
+    return 'working', info
+
+async def deep_validate(session, index, cache=None):
+    """Run validate_stream over working manifest URLs, bounded by DEEP_VALIDATION_MAX
+    
+    Streams with an unknown (keyword-guessed) quality go first; each unique stream
+    is fetched once and the result applied to every channel that references it
+    (`index` is the scheduler's ProbeIndex or RowIndex).
+    """
+    candidates = [
+        ch for ch in index.heads('working')
+        if ch.stream_info is None and is_manifest_url(ch.url)
+    ]
+    candidates.sort(key=lambda ch: (ch.quality_score != 50, ch.ping))
+    candidates = candidates[:DEEP_VALIDATION_MAX]
+    if not candidates:
+        return
+    
+    semaphore = asyncio.Semaphore(DEEP_VALIDATION_CONCURRENCY)
+    verdicts = defaultdict(int)
+    heights = defaultdict(int)
+    
+    async def validate(ch):
+        async with semaphore:
+            verdict, info = await validate_stream(session, ch.url)
+        verdicts[verdict] += 1
+        
+        height = effective_height(info)
+        if height:
+            heights['4K' if height >= 2160 else '1080p' if height >= 1080 else '<1080p'] += 1
+        
+        if verdict == 'dead':
+            ch.status = 'dead'
+            ch.reason = 'manifest'
+        elif info:
+            ch.apply_stream_info(info)
+        followers = index.fan_out(ch)
+        if cache is not None and verdict != 'inconclusive':
+            cache.record_group([ch, *followers])
+    
+    logging.info(f"Deep validation of {len(candidates)} manifest streams...")
+    await asyncio.gather(*(validate(ch) for ch in candidates))
+    logging.info(
+        f"Deep validation: working {verdicts['working']}, dead {verdicts['dead']}, "
+        f"inconclusive {verdicts['inconclusive']} | resolution 4K: {heights['4K']}, "
+        f"1080p: {heights['1080p']}, below 1080p: {heights['<1080p']}"
+    )
+
+# =======================================================================================
+# CHANNEL TABLE (columnar catalogue)
+# =======================================================================================
+
+class StringPool:
+    """Interns a low-cardinality string column as small integer codes"""
+    
+    __slots__ = ['codes', 'values']
+    
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+class ChannelTable:
+    """Parallel columns for the whole catalogue instead of one IPTVChannel object per row
+    
+    Free-text fields stay as plain string lists; category, country, group-title,
+    status and failure reason are interned into compact integer arrays, and
+    ping/quality/url_hash live in typed `array` columns. Rows are appended straight
+    from the parse-worker records at ingest and only materialised back into
+    IPTVChannel objects while a stream is probed and for the channels written out.
+    """
+    
+    def __init__(self):
+        self.names = []
+        self.urls = []
+        self.url_keys = []
+        self.names_normalized = []
+        self.tvg_ids = []
+        self.tvg_names = []  # None khi trùng với name (trường hợp phổ biến)
+        self.url_hashes = array('Q')
+        self.ping = array('d')
+        self.quality = array('h')
+        self.category = array('B')
+        self.country = array('B')
+        self.group = array('I')
+        self.status = array('B')
+        self.reason = array('B')
+        self.source = array('H')
+        self.stream_info = {}  # Thưa: chỉ các row đã deep-validate
+        self.timing = {}       # Thưa: chỉ row đầu của mỗi stream đã probe thật
+        self.categories = StringPool()
+        self.countries = StringPool()
+        self.groups = StringPool()
+        self.statuses = StringPool()
+        self.reasons = StringPool()
+        self.sources = StringPool()
+        self.unchecked = self.statuses.code('unchecked')
+        self.no_reason = self.reasons.code(None)
+
+    def __len__(self):
+        return len(self.urls)
+
+    @classmethod
+    def from_channels(cls, channels):
+        table = cls()
+        for ch in channels:
+            table.append(ch)
+        return table
+
+    def append_record(self, record, source=None):
+        """Append one unchecked row from an IPTVChannel.to_record() tuple (as the parse workers return it)"""
+        (name, url, category, tvg_id, tvg_name, group_title, url_hash,
+         url_key, name_normalized, country, quality_score) = record
+        row = len(self.urls)
+        self.names.append(name)
+        self.urls.append(url)
+        self.url_keys.append(url_key)
+        self.names_normalized.append(name_normalized)
+        self.tvg_ids.append(tvg_id)
+        self.tvg_names.append(None if tvg_name == name else tvg_name)
+        self.url_hashes.append(int(url_hash, 16))
+        self.ping.append(float('inf'))
+        self.quality.append(quality_score)
+        self.category.append(self.categories.code(category))
+        self.country.append(self.countries.code(country))
+        self.group.append(self.groups.code(group_title))
+        self.status.append(self.unchecked)
+        self.reason.append(self.no_reason)
+        self.source.append(self.sources.code(source))
+        return row
+
+    def append(self, channel):
+        row = self.append_record(channel.to_record(), channel.source)
+        self.store(row, channel)
+        return row
+
+    def store(self, row, channel):
+        """Write a channel's verdict (status, ping, reason, stream info, timing) into `row`"""
+        self.status[row] = self.statuses.code(channel.status)
+        self.reason[row] = self.reasons.code(channel.reason)
+        self.ping[row] = channel.ping
+        self.quality[row] = channel.quality_score
+        if channel.stream_info is not None:
+            self.stream_info[row] = channel.stream_info
+        if channel.timing is not None:
+            self.timing[row] = channel.timing
+
+    def copy_result(self, source, target):
+        """Give `target` the verdict of `source` (same stream referenced twice), like ProbeIndex._copy"""
+        self.status[target] = self.status[source]
+        self.reason[target] = self.reason[source]
+        self.ping[target] = self.ping[source]
+        info = self.stream_info.get(source)
+        if info is not None:
+            self.stream_info[target] = info
+            if effective_height(info):
+                self.quality[target] = self.quality[source]
+
+    def outcomes(self):
+        """(source, status, reason) for every row, decoded straight from the columns"""
+        sources, statuses, reasons = self.sources.values, self.statuses.values, self.reasons.values
+        for source, status, reason in zip(self.source, self.status, self.reason):
+            yield sources[source], statuses[status], reasons[reason]
+
+    def timed_channels(self):
+        """Channels of the rows that carry a probe timing breakdown"""
+        for row in self.timing:
+            yield self.channel(row)
+
+    def channel(self, row):
+        """Materialise one row back into an IPTVChannel (fields set directly, no record tuple)"""
+        ch = IPTVChannel.__new__(IPTVChannel)
+        ch.name = name = self.names[row]
+        tvg_name = self.tvg_names[row]
+        ch.attributes = {
+            'tvg-id': self.tvg_ids[row],
+            'tvg-name': name if tvg_name is None else tvg_name,
+            'group-title': self.groups.values[self.group[row]],
+        }
+        ch.url = self.urls[row]
+        ch.category = self.categories.values[self.category[row]]
+        ch.url_hash = f'{self.url_hashes[row]:016x}'
+        ch.url_key = self.url_keys[row]
+        ch.name_normalized = self.names_normalized[row]
+        ch.country = self.countries.values[self.country[row]]
+        ch.quality_score = self.quality[row]
+        ch.status = self.statuses.values[self.status[row]]
+        ch.reason = self.reasons.values[self.reason[row]]
+        ch.source = self.sources.values[self.source[row]]
+        ch.ping = self.ping[row]
+        ch.stream_info = self.stream_info.get(row)
+        ch.timing = self.timing.get(row)
+        ch.fallbacks = None
+        ch.row = row
+        return ch
+
+# =======================================================================================
+# NEAR-DUPLICATE CLUSTERING
+# =======================================================================================
+
+# Tag phát sinh từ bản encode/nguồn, không thuộc tên kênh (hd/fhd/1080p/channel... đã bị _normalize_name bỏ)
+_CLUSTER_NOISE_RE = re.compile(
+    r'\b(hevc|h264|h265|x264|x265|avc|2160p|1080i|576p|480p|360p|50fps|60fps|geoblocked|not 247|backup)\b')
+_DIGITS_RE = re.compile(r'\d+')
+
+def cluster_signature(name_normalized):
+    """(trigram source, number tokens) used to compare two normalised names"""
+    name = _CLUSTER_NOISE_RE.sub('', name_normalized)
+    return name.replace(' ', ''), tuple(_DIGITS_RE.findall(name))
+
+def _trigrams(text):
+    if len(text) < 3:
+        return {text}
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+_MINHASH_PRIME = (1 << 61) - 1
+
+def _minhash_seeds(count, seed=7):
+    rng = random.Random(seed)
+    return [(rng.randrange(1, _MINHASH_PRIME), rng.randrange(_MINHASH_PRIME)) for _ in range(count)]
+
+_MINHASH_SEEDS = _minhash_seeds(FUZZY_DEDUP_BANDS * FUZZY_DEDUP_ROWS)
+
+def _gram_hashes(gram):
+    """One value per MinHash permutation; deterministic across runs (no PYTHONHASHSEED)"""
+    value = int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), 'big')
+    return [(a * value + b) % _MINHASH_PRIME for a, b in _MINHASH_SEEDS]
+
+def _epg_key(tvg_id):
+    """EPG-style tvg-id ("BBCNews.uk@HD" -> "bbcnews.uk"); None for ids generated from the name"""
+    key = tvg_id.split('@', 1)[0].strip().lower()
+    return key if '.' in key and len(key) > 3 else None
+
+def cluster_near_duplicates(blocks, names, tvg_ids=None, threshold=FUZZY_DEDUP_THRESHOLD):
+    """Label each item with a cluster id; items only join clusters within the same block
+    
+    Identical signatures and shared EPG tvg-ids are linked through dicts. Distinct
+    signatures are bucketed by MinHash-LSH over their trigram sets, so only names
+    that share a whole band of min-hashes are ever compared; each candidate pair is
+    then checked on number tokens ("Sport 1" != "Sport 2") and the exact Jaccard.
+    Buckets only hold likely near-duplicates, so the work stays linear in the input.
+    """
+    parent = list(range(len(names)))
+    
+    def find(item):
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+    
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    
+    # Tên trùng hoàn toàn sau khi bỏ tag: gộp ngay, chỉ một đại diện vào bước so khớp
+    first = {}
+    signatures = {}
+    for item, (block, name) in enumerate(zip(blocks, names)):
+        signature = signatures.get(name)
+        if signature is None:
+            signature = signatures[name] = cluster_signature(name)
+        key = (block, signature)
+        if key in first:
+            union(first[key], item)
+        else:
+            first[key] = item
+    
+    if tvg_ids is not None:
+        by_epg = {}
+        for item, (block, tvg_id) in enumerate(zip(blocks, tvg_ids)):
+            key = _epg_key(tvg_id)
+            if key is not None:
+                union(by_epg.setdefault((block, key), item), item)
+    
+    # MinHash-LSH trên các signature khác nhau; hash của mỗi trigram chỉ tính một lần
+    gram_hashes = {}
+    buckets = defaultdict(list)
+    rows = FUZZY_DEDUP_ROWS
+    for (block, (text, digits)), item in first.items():
+        grams = _trigrams(text)
+        vectors = []
+        for gram in grams:
+            vector = gram_hashes.get(gram)
+            if vector is None:
+                vector = gram_hashes[gram] = _gram_hashes(gram)
+            vectors.append(vector)
+        minhash = tuple(map(min, zip(*vectors)))
+        
+        seen = set()
+        for band in range(FUZZY_DEDUP_BANDS):
+            bucket = buckets[(block, band, minhash[band * rows:(band + 1) * rows])]
+            for other, other_digits, other_grams in bucket[:FUZZY_DEDUP_SCAN_LIMIT]:
+                if other in seen:
+                    continue
+                seen.add(other)
+                if other_digits != digits:
+                    continue
+                overlap = len(grams & other_grams)
+                if overlap >= threshold * (len(grams) + len(other_grams) - overlap):
+                    union(item, other)
+            bucket.append((item, digits, grams))
+    
+    return [find(item) for item in range(len(names))]
+
+# =======================================================================================
+# ENHANCED FILTERING WITH QUALITY CHECKS
+# =======================================================================================
+
+def filter_and_deduplicate(channels):
+    """Enhanced filtering with quality and ping requirements
     
-    async with aiohttp.ClientSession(
+    Accepts a ChannelTable (or a channel list, converted once) and runs the
+    working/quality/ping filters and the URL dedup as one pass over the columns.
+    """
+    table = channels if isinstance(channels, ChannelTable) else ChannelTable.from_channels(channels)
+    logging.info(f"Starting quality filtering on {len(table)} channels...")
+    
+    ping = table.ping
+    quality = table.quality
+    status = table.status
+    url_keys = table.url_keys
+    working_code = table.statuses.codes.get('working', -1)
+    blocked_code = table.countries.codes.get('BLOCKED', -1)
+    country = table.country
+    
+    # STEP 1-4: working → chất lượng → ping → trùng URL (giữ ping tốt nhất), một lần duyệt
+    # Cột status là mảng byte: regex tìm row 'working' ở tầng C, Python chỉ duyệt phần nhỏ còn lại
+    working_rows = [
+        match.start() for match in re.finditer(re.escape(bytes([working_code])), status.tobytes())
+    ] if working_code >= 0 else []
+    working = len(working_rows)
+    high_quality = fast = 0
+    url_map = {}
+    best_ping = {}
+    for row in working_rows:
+        # Loại bỏ kênh RÕ RÀNG chất lượng thấp hoặc bị chặn
+        if quality[row] == 0 or country[row] == blocked_code:
+            continue
+        high_quality += 1
+        row_ping = ping[row]
+        if row_ping > MAX_ACCEPTABLE_PING_MS:
+            continue
+        fast += 1
+        key = url_keys[row]
+        if key not in url_map or row_ping < best_ping[key]:
+            url_map[key] = row
+            best_ping[key] = row_ping
+    
+    logging.info(f"Working channels: {working}/{len(table)}")
+    if not working:
+        return []
+    
+    logging.info(f"After quality filter (removed low-quality tags & blocked countries): {high_quality}/{working}")
+    if not high_quality:
+        logging.warning("No channels passed quality filter!")
+        return []
+    
+    logging.info(f"Fast enough (ping <= {MAX_ACCEPTABLE_PING_MS}ms): {fast}/{high_quality}")
+    if not fast:
+        return []
+    
+    logging.info(f"After URL deduplication: {len(url_map)}")
+    
+    # STEP 5: Gộp kênh trùng/gần trùng tên theo quốc gia + category
+    # (ƯU TIÊN chất lượng cao hơn → ping thấp hơn; dự phòng ghi riêng ra FALLBACK_FILENAME)
+    names_normalized = table.names_normalized
+    category = table.category
+    candidates = list(url_map.values())
+    blocks = [(country[row], category[row]) for row in candidates]
+    if FUZZY_DEDUP:
+        labels = cluster_near_duplicates(blocks, [names_normalized[row] for row in candidates],
+                                         [table.tvg_ids[row] for row in candidates])
+    else:
+        labels = [(block, names_normalized[row]) for block, row in zip(blocks, candidates)]
+    
+    url_hashes = table.url_hashes
+    clusters = defaultdict(list)
+    for label, row in zip(labels, candidates):
+        clusters[label].append(row)
+    
+    # Mỗi cụm chỉ ra một kênh; dự phòng là metadata của kênh đó, không thành entry riêng
+    primaries = []
+    fallbacks = {}
+    for members in clusters.values():
+        if len(members) > 1:
+            members.sort(key=lambda row: (-quality[row], ping[row], url_hashes[row]))
+            if FUZZY_DEDUP and FUZZY_DEDUP_FALLBACKS:
+                # Dự phòng ở host khác có ích hơn: host đó sập thì kênh vẫn còn đường lui
+                primary_host = channel_origin(table.urls[members[0]])
+                rest = sorted(members[1:], key=lambda row: channel_origin(table.urls[row]) == primary_host)
+                fallbacks[members[0]] = [table.urls[row] for row in rest[:FUZZY_DEDUP_FALLBACKS]]
+        primaries.append(members[0])
+    
+    logging.info(f"After name deduplication: {len(primaries)} channels "
+                 f"({len(candidates) - len(primaries)} variants merged, "
+                 f"{len(fallbacks)} with fallback streams)")
+    
+    # STEP 6: Sort by quality and ping tier; name + url_hash make the order deterministic
+    # (ping chính xác dao động mỗi lần chạy, xếp theo nó sẽ xáo trộn toàn bộ playlist)
+    category_names = table.categories.values
+    
+    def rank(row):
+        row_ping = ping[row]
+        tier = 0 if row_ping <= EXCELLENT_PING_MS else 1 if row_ping <= GOOD_PING_MS else 2
+        return (category_names[category[row]], -quality[row], tier, names_normalized[row], url_hashes[row])
+    
+    rows = sorted(primaries, key=rank)
+    
+    # Statistics (một lần duyệt)
+    uhd_4k = fhd_1080 = unknown = enhanced = 0
+    excellent = good = acceptable = 0
+    for row in rows:
+        score = quality[row]
+        if score >= 100:
+            uhd_4k += 1
+        elif score >= 80:
+            fhd_1080 += 1
+        elif score == 50:
+            unknown += 1
+        elif score > 50:
+            enhanced += 1
+        
+        if ping[row] <= EXCELLENT_PING_MS:
+            excellent += 1
+        elif ping[row] <= GOOD_PING_MS:
+            good += 1
+        else:
+            acceptable += 1
+    
+    logging.info(f"Final channels: {len(rows)}")
+    logging.info(f"  └─ 4K/UHD: {uhd_4k} | 1080p: {fhd_1080} | Unknown quality: {unknown} | Enhanced: {enhanced}")
+    logging.info(f"Ping breakdown - Excellent: {excellent}, Good: {good}, Acceptable: {acceptable}")
+    
+    final_channels = []
+    for row in rows:
+        ch = table.channel(row)
+        ch.fallbacks = fallbacks.get(row)
+        final_channels.append(ch)
+    return final_channels
+
+# =======================================================================================
+# OUTPUT GENERATION
+# =======================================================================================
+
+PLAYLIST_UPDATED_PREFIX = '#EXTINF:-1,Optimized Playlist - Updated: '
+
+def generate_m3u_playlist(channels):
+    """Enhanced M3U generation with quality info; yields the playlist line by line"""
+    logging.info("Generating high-quality M3U playlist...")
+    yield from iter_playlist_lines(channels)
+    logging.info(f"Generated playlist with {len(channels)} optimized channels")
+
+def iter_playlist_lines(channels):
+    """Header, then one block per category (shared by the full playlist and the shards)"""
+    yield '#EXTM3U'
+    yield f'{PLAYLIST_UPDATED_PREFIX}{datetime.now().strftime("%Y-%m-%d %H:%M UTC")}'
+    yield f'#EXTINF:-1,Total: {len(channels)} channels (Prioritized: 1080p+, Fast Ping, No Low Quality)'
+    yield ''
+    
+    # Group by category
+    grouped = defaultdict(list)
+    for ch in channels:
+        grouped[ch.category].append(ch)
+    
+    for category in sorted(grouped.keys()):
+        category_channels = grouped[category]
+        # Làm tròn 100ms để ping dao động nhẹ không làm đổi file
+        avg_ping = round(sum(ch.ping for ch in category_channels) / len(category_channels), -2)
+        
+        yield f'#EXTINF:-1,━━━ {category.upper()} ({len(category_channels)} channels, avg {avg_ping:.0f}ms) ━━━'
+        yield ''
+        
+        for ch in category_channels:
+            yield ch.to_m3u_entry()
+            yield ''
+
+def _playlist_piece(index, line):
+    """Bytes of one line as they count towards the content hash (the timestamp line is ignored)"""
+    text = '' if line.startswith(PLAYLIST_UPDATED_PREFIX) else line
+    return (text if index == 0 else '\n' + text).encode('utf-8')
+
+class PlaylistIndex:
+    """The previously published playlist: content hash and entry order keyed by url_hash"""
+    
+    def __init__(self, content_hash=None, order=(), urls=None):
+        self.content_hash = content_hash
+        self.order = list(order)
+        self.urls = urls or {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                text = f.read()
+        except OSError:
+            return cls()
+        
+        digest = hashlib.sha256()
+        order = []
+        urls = {}
+        for i, line in enumerate(text.split('\n')):
+            digest.update(_playlist_piece(i, line))
+            if line.startswith('http'):
+                url_hash = hashlib.md5(line.encode()).hexdigest()[:16]
+                order.append(url_hash)
+                urls[url_hash] = line
+        return cls(digest.hexdigest(), order, urls)
+
+def write_playlist(path, lines, previous=None):
+    """Stream lines to a temp file and swap it in, unless only the timestamp changed
+    
+    Returns (content_hash, changed).
+    """
+    tmp_path = f"{path}.tmp"
+    digest = hashlib.sha256()
+    with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+        for i, line in enumerate(lines):
+            f.write(line if i == 0 else '\n' + line)
+            digest.update(_playlist_piece(i, line))
+    
+    content_hash = digest.hexdigest()
+    if previous is not None and content_hash == previous.content_hash:
+        os.remove(tmp_path)
+        return content_hash, False
+    
+    os.replace(tmp_path, path)
+    return content_hash, True
+
+def _longest_increasing(values):
+    """Indices of one longest strictly increasing subsequence of `values`"""
+    tails, tail_index, parents = [], [], [None] * len(values)
+    for i, value in enumerate(values):
+        pos = bisect_left(tails, value)
+        if pos == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[pos] = value
+            tail_index[pos] = i
+        parents[i] = tail_index[pos - 1] if pos else None
+    
+    kept = set()
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        kept.add(i)
+        i = parents[i]
+    return kept
+
+def build_playlist_delta(previous, channels, content_hash):
+    """Added, removed and moved entries relative to the previous playlist
+    
+    "moved" is the smallest set of surviving entries whose relative order changed
+    (everything outside a longest increasing run of old positions), so one insertion
+    does not mark every later channel as re-ranked.
+    """
+    ordered = sorted(channels, key=lambda ch: ch.category)  # Cùng thứ tự với generate_m3u_playlist
+    old_rank = {url_hash: rank for rank, url_hash in enumerate(previous.order)}
+    new_hashes = {ch.url_hash for ch in ordered}
+    
+    added = []
+    survivors = []
+    for rank, ch in enumerate(ordered):
+        if ch.url_hash in old_rank:
+            survivors.append((rank, ch))
+        else:
+            added.append({'url_hash': ch.url_hash, 'rank': rank, 'name': ch.name,
+                          'category': ch.category, 'url': ch.url})
+    
+    in_place = _longest_increasing([old_rank[ch.url_hash] for _, ch in survivors])
+    moved = [
+        {'url_hash': ch.url_hash, 'from': old_rank[ch.url_hash], 'to': rank}
+        for i, (rank, ch) in enumerate(survivors) if i not in in_place
+    ]
+    removed = [
+        {'url_hash': url_hash, 'url': previous.urls[url_hash]}
+        for url_hash in previous.order if url_hash not in new_hashes
+    ]
+    
+    return {
+        'updated': datetime.now().strftime("%Y-%m-%d %H:%M UTC"),
+        'previous_hash': previous.content_hash,
+        'content_hash': content_hash,
+        'total': len(ordered),
+        'added': added,
+        'removed': removed,
+        'moved': moved,
+    }
+
+_SLUG_RE = re.compile(r'[^a-z0-9]+')
+
+SHARD_KINDS = {
+    'category': lambda ch: ch.category,
+    'country': lambda ch: ch.country,
+    'group': lambda ch: ch.attributes['group-title'],
+}
+
+def _shard_slug(value, taken):
+    """File-name-safe slug, suffixed with a short hash when two values slug the same"""
+    slug = _SLUG_RE.sub('-', value.lower()).strip('-')[:60] or 'other'
+    if slug in taken:
+        slug = f"{slug}-{hashlib.md5(value.encode()).hexdigest()[:6]}"
+    taken.add(slug)
+    return slug
+
+def load_shard_index(path=SHARD_INDEX_FILENAME):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_shards(channels, shard_dir=SHARD_DIR, index_path=SHARD_INDEX_FILENAME):
+    """Write one playlist per category, country and group-title plus a JSON index of them
+    
+    A shard is only rewritten when its content hash differs from the one recorded in
+    the previous index, so unchanged shards keep their bytes (and HTTP cache headers).
+    The index only holds content-derived fields and is itself rewritten only when it
+    changes, so a run with identical shards leaves no diff to commit.
+    Returns (index, written).
+    """
+    previous_index = load_shard_index(index_path)
+    previous = {
+        entry['file']: entry['content_hash']
+        for shards in previous_index.get('shards', {}).values()
+        for entry in shards.values()
+    }
+    
+    shards = {}
+    files = set()
+    written = 0
+    for kind, key_of in SHARD_KINDS.items():
+        grouped = defaultdict(list)
+        for ch in channels:
+            grouped[key_of(ch) or 'Other'].append(ch)
+        
+        os.makedirs(os.path.join(shard_dir, kind), exist_ok=True)
+        taken = set()
+        shards[kind] = {}
+        for key in sorted(grouped):
+            members = grouped[key]
+            file = posixpath.join(kind, f"{_shard_slug(key, taken)}.m3u")
+            path = os.path.join(shard_dir, file)
+            known = PlaylistIndex(previous.get(file)) if os.path.exists(path) else None
+            content_hash, changed = write_playlist(path, iter_playlist_lines(members), known)
+            written += changed
+            files.add(file)
+            shards[kind][key] = {
+                'file': file,
+                'channels': len(members),
+                'content_hash': content_hash,
+            }
+    
+    # Shard không còn kênh nào: xoá để client không tải playlist cũ
+    for file in previous.keys() - files:
+        try:
+            os.remove(os.path.join(shard_dir, file))
+        except OSError:
+            pass
+    
+    # Không ghi timestamp/ping vào index: chúng đổi mỗi lần chạy và tạo commit rỗng
+    index = {
+        'total': len(channels),
+        'shards': shards,
+    }
+    if index != previous_index:
+        _write_atomic(index_path, json.dumps(index, ensure_ascii=False, indent=1))
+    return index, written
+
+def publish_playlist(final_channels):
+    """Write playlist.m3u, its delta feed, fallbacks and shards; returns True if the playlist changed"""
+    # Save (chỉ ghi lại khi nội dung khác lần trước, kèm delta cho client/git history)
+    previous = PlaylistIndex.load(OUTPUT_FILENAME)
+    content_hash, changed = write_playlist(OUTPUT_FILENAME, generate_m3u_playlist(final_channels), previous)
+    if changed:
+        delta = build_playlist_delta(previous, final_channels, content_hash)
+        _write_atomic(DELTA_FILENAME, json.dumps(delta, ensure_ascii=False, indent=1))
+        logging.info(
+            f"Playlist delta: +{len(delta['added'])} added, -{len(delta['removed'])} removed, "
+            f"{len(delta['moved'])} moved ({DELTA_FILENAME})"
+        )
+    else:
+        logging.info("Playlist content unchanged since last run, kept existing file")
+    
+    if FUZZY_DEDUP and FUZZY_DEDUP_FALLBACKS:
+        fallbacks = {ch.url_hash: ch.fallbacks for ch in final_channels if ch.fallbacks}
+        # Không kèm thời gian: mapping không đổi thì file giữ nguyên byte, CI không commit thừa
+        _write_atomic(FALLBACK_FILENAME, json.dumps(fallbacks, ensure_ascii=False, indent=1, sort_keys=True))
+        logging.info(f"Fallback streams for {len(fallbacks)} channels ({FALLBACK_FILENAME})")
+    
+    if SHARD_OUTPUT:
+        index, written = write_shards(final_channels)
+        logging.info(
+            f"Shards: {sum(len(shards) for shards in index['shards'].values())} playlists "
+            f"({written} rewritten) indexed in {SHARD_INDEX_FILENAME}"
+        )
+    return changed
+
+# =======================================================================================
+# PIPELINE: FETCH → PARSE → FILTER → CHECK
+# =======================================================================================
+
+def create_session(resolver=None):
+    """Shared ClientSession: pooled keep-alive connector, DNS cache and probe timing hooks"""
+    connector = aiohttp.TCPConnector(
+        resolver=resolver,
+        limit=200,
+        limit_per_host=HOST_MAX_CONCURRENCY,
+        ttl_dns_cache=600,
+        keepalive_timeout=30,
+        force_close=False,
+    )
+    return aiohttp.ClientSession(
         connector=connector,
         headers=REQUEST_HEADERS,
-        timeout=aiohttp.ClientTimeout(total=300)
-    ) as session:
-        # Phase 1: Fetch sources
-        logging.info("\n[1/3] FETCHING SOURCES")
-        logging.info("-" * 60)
+        timeout=aiohttp.ClientTimeout(total=300),
+        trace_configs=[create_probe_trace_config()]
+    )
+
+async def run_pipeline(session, scheduler, table):
+    """Run all stages concurrently; returns once every probe is done
+    
+    Sources stream records into a bounded queue; the filter stage drops low-quality
+    and blocked channels, appends the rest to `table` and submits the first row of
+    each canonical URL to the probe pool (the scheduler's RowIndex), so checks start
+    while slow sources are still downloading.
+    """
+    channel_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    index = scheduler.index
+    
+    async def produce(url, category):
+        async for record in iter_source_records(session, url, category):
+            await channel_queue.put((record, url))
+    
+    async def close_when_fetched():
+        producers = [
+            produce(url, category)
+            for category, urls in SOURCES.items()
+            for url in urls
+        ]
+        await asyncio.gather(*producers, return_exceptions=True)
+        await channel_queue.put(None)
+    
+    fetcher = asyncio.create_task(close_when_fetched())
+    scheduler.start()
+    
+    parsed = 0
+    
+    async def consume():
+        nonlocal parsed
+        while True:
+            item = await channel_queue.get()
+            if item is None:
+                break
+            parsed += 1
+            record, source = item
+            
+            # Pre-filter (chỉ loại bỏ kênh RÕ RÀNG chất lượng thấp); URL trùng do RowIndex gộp
+            if not IPTVChannel.record_is_high_quality(record):
+                continue
+            METRICS.inc('iptv_source_channels_total', source=source, stage='prefiltered')
+            row = table.append_record(record, source)
+            if index.add_row(row):
+                await scheduler.submit(table.channel(row))
+        
+        logging.info(f"All sources fetched: {parsed} channels, {len(table)} queued for checking")
+    
+    try:
+        try:
+            await asyncio.wait_for(consume(), scheduler.time_left())
+        except asyncio.TimeoutError:
+            logging.warning(f"Probe deadline reached while fetching: stopped after {parsed} channels")
+        await scheduler.drain()
+    finally:
+        fetcher.cancel()
+        await asyncio.gather(fetcher, return_exceptions=True)
+
+# =======================================================================================
+# DAEMON: CONTINUOUS ROLLING RE-VALIDATION
+# =======================================================================================
+
+class RevalidationDaemon:
+    """Keeps the catalogue in memory and re-probes each stream when it falls due
+    
+    Every unique stream has a due time: stable working streams come back after
+    DAEMON_WORKING_INTERVAL, dead ones after the health cache backoff, and both are
+    shortened for streams whose verdict keeps flipping. Due streams are fed to one
+    long-lived ProbeScheduler at a paced rate, and the playlist is republished
+    whenever a verdict changes the working set.
+    """
+    
+    def __init__(self, session, cache, on_publish=None):
+        self.session = session
+        self.cache = cache
+        self.on_publish = on_publish
+        self.scheduler = ProbeScheduler(session, cache, on_result=self._on_result)
+        self.due = []             # heap of (due_at, -quality_score, seq, url_key)
+        self.scheduled = {}       # url_key -> seq của mục heap còn hiệu lực
+        self.last_status = {}     # url_key -> verdict gần nhất
+        self.flakiness = {}       # url_key -> EWMA của số lần đổi verdict
+        self.dirty = False
+        self._seq = 0
+
+    async def run(self):
+        self.scheduler.start()
+        tasks = [
+            asyncio.create_task(self._refresh_loop()),
+            asyncio.create_task(self._pace()),
+            asyncio.create_task(self._publish_loop()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.cache.save()
+
+    # --- catalogue --------------------------------------------------------------------
+
+    async def refresh_sources(self):
+        """Re-stream SOURCES into the live index, keeping verdicts of known streams
         
-        tasks = []
-        for category, urls in SOURCES.items():
-            for url in urls:
-                tasks.append(fetch_source(session, url, category))
+        Channels are merged while each source is still downloading, so no source is
+        held as a whole list and DAEMON_MAX_STREAMS is enforced during ingest. Streams
+        no source listed this round are swept once every source has finished.
+        """
+        index = self.scheduler.index
+        seen = set()
+        accepted = dropped = 0
         
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        def ingest(ch):
+            nonlocal accepted, dropped
+            key = ch.url_key
+            group = index.groups.get(key)
+            if key in seen:
+                group.append(ch)
+                if group[0].status != 'unchecked':
+                    ProbeIndex._copy(group[0], ch)
+            elif len(seen) >= DAEMON_MAX_STREAMS:
+                dropped += 1
+                return
+            else:
+                seen.add(key)
+                if group is None:
+                    index.groups[key] = [ch]
+                    self._admit(ch)
+                else:
+                    # Stream đã biết: kênh mới thay head cũ, follower của vòng trước bị bỏ
+                    ProbeIndex._copy(group[0], ch)
+                    index.groups[key] = [ch]
+            accepted += 1
         
-        for result in results:
-            if isinstance(result, list):
-                all_channels.extend(result)
+        async def consume(category, url):
+            async for record in iter_source_records(self.session, url, category):
+                if IPTVChannel.record_is_high_quality(record):
+                    ch = IPTVChannel.from_record(record)
+                    ch.source = url
+                    ingest(ch)
         
-        # Pre-filter by quality before checking (chỉ loại bỏ kênh RÕ RÀNG chất lượng thấp)
-        all_channels = [ch for ch in all_channels if ch.is_high_quality()]
-        logging.info(f"Channels after pre-filter (removed low-quality & blocked): {len(all_channels)}")
+        await asyncio.gather(
+            *(consume(category, url) for category, urls in SOURCES.items() for url in urls),
+            return_exceptions=True
+        )
         
-        if not all_channels:
-            logging.error("No channels passed pre-filter (all are low-quality or blocked)!")
+        for key in index.groups.keys() - seen:
+            del index.groups[key]
+            self.scheduled.pop(key, None)
+            self.flakiness.pop(key, None)
+            if self.last_status.pop(key, None) == 'working':
+                self.dirty = True
+        index.channels = accepted
+        
+        # Cho host bị short-circuit ở vòng trước một cơ hội mới
+        for host in self.scheduler.hosts.values():
+            host.down = False
+            host.answered = False
+            host.timeouts_in_row = 0
+        
+        logging.info(
+            f"Daemon catalogue: {len(index.groups)} streams for {index.channels} channels"
+            + (f" ({dropped} dropped over DAEMON_MAX_STREAMS)" if dropped else "")
+        )
+
+    def _admit(self, channel):
+        """Seed a new stream from a fresh health-cache verdict, or make it due right away"""
+        if self.cache.apply(channel):
+            self.scheduler.index.fan_out(channel)
+            self.last_status[channel.url_key] = channel.status
+            self.dirty = self.dirty or channel.status == 'working'
+            self._schedule(channel, self.cache.entries[channel.url_hash][2])
+        else:
+            self._push(channel, time.time())
+
+    # --- scheduling -------------------------------------------------------------------
+
+    def _interval(self, channel):
+        key = channel.url_key
+        if channel.status == 'working':
+            interval = DAEMON_WORKING_INTERVAL
+        else:
+            entry = self.cache.entries.get(channel.url_hash)
+            interval = HealthCache.dead_ttl(entry[3] if entry else 1)
+        # Kênh chập chờn được kiểm tra dày hơn (tới DAEMON_MIN_INTERVAL)
+        interval /= 1 + 4 * self.flakiness.get(key, 0.0)
+        return max(DAEMON_MIN_INTERVAL, interval)
+
+    def _schedule(self, channel, checked_at):
+        # Jitter ±10% để các stream kiểm tra cùng lúc không dồn lại thành đợt
+        self._push(channel, checked_at + self._interval(channel) * random.uniform(0.9, 1.1))
+
+    def _push(self, channel, due_at):
+        self._seq += 1
+        self.scheduled[channel.url_key] = self._seq
+        heapq.heappush(self.due, (due_at, -channel.quality_score, self._seq, channel.url_key))
+
+    def _on_result(self, channel):
+        key = channel.url_key
+        group = self.scheduler.index.groups.get(key)
+        if group is None:
             return
+        # Probe bắt đầu trước khi làm mới nguồn: chép kết quả sang object mới
+        if group[0] is not channel:
+            ProbeIndex._copy(channel, group[0])
+            self.scheduler.index.fan_out(group[0])
         
-        # Phase 2: Check channels
-        logging.info("\n[2/3] CHECKING CHANNELS (Quality-Optimized)")
-        logging.info("-" * 60)
+        previous = self.last_status.get(key)
+        flipped = previous is not None and previous != channel.status
+        self.flakiness[key] = 0.7 * self.flakiness.get(key, 0.0) + (0.3 if flipped else 0.0)
+        if flipped or (previous is None and channel.status == 'working'):
+            self.dirty = True
+        self.last_status[key] = channel.status
+        self._schedule(channel, time.time())
+
+    # --- loops ------------------------------------------------------------------------
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh_sources()
+            except Exception as e:
+                logging.error(f"Daemon source refresh failed: {str(e)[:80]}")
+            await asyncio.sleep(DAEMON_SOURCE_REFRESH)
+
+    async def _pace(self):
+        """Hand due streams to the scheduler, at most one every 1/rate seconds"""
+        scheduler = self.scheduler
+        while True:
+            if not self.due:
+                await asyncio.sleep(1)
+                continue
+            
+            due_at, _, seq, key = self.due[0]
+            wait = due_at - time.time()
+            if wait > 0:
+                await asyncio.sleep(min(wait, 1))
+                continue
+            heapq.heappop(self.due)
+            
+            group = scheduler.index.groups.get(key)
+            if group is None or self.scheduled.get(key) != seq:
+                continue
+            del self.scheduled[key]
+            
+            # Queue của scheduler không vượt quá số worker (bộ nhớ và độ trễ có giới hạn)
+            while scheduler.queue.qsize() >= scheduler.workers:
+                await asyncio.sleep(0.05)
+            scheduler.recheck(group[0])
+            
+            startup = len(self.last_status) < len(scheduler.index.groups)
+            await asyncio.sleep(1 / (DAEMON_STARTUP_PROBE_RATE if startup else DAEMON_PROBE_RATE))
+
+    async def _publish_loop(self):
+        while True:
+            await asyncio.sleep(DAEMON_PUBLISH_INTERVAL)
+            if not self.dirty:
+                continue
+            self.dirty = False
+            
+            # Lọc/gộp trùng mất vài giây CPU với catalogue lớn: chạy trong thread để loop vẫn
+            # probe và phục vụ. Chỉ chụp danh sách group trên loop; verdict đổi trong lúc đó
+            # sẽ vào lần publish sau (dirty được đặt lại)
+            groups = [list(group) for group in self.scheduler.index.groups.values()]
+            loop = asyncio.get_running_loop()
+            published = await loop.run_in_executor(None, self._publish, groups)
+            if published and self.on_publish is not None:
+                await self.on_publish()
+            self.cache.save()
+            os.makedirs(os.path.dirname(METRICS_PROM) or '.', exist_ok=True)
+            _write_atomic(METRICS_PROM, METRICS.to_prometheus())
+
+    @staticmethod
+    def _publish(groups):
+        """Filter a snapshot of the catalogue and write the outputs (runs in a worker thread)"""
+        channels = [ch for group in groups for ch in group]
+        final_channels = filter_and_deduplicate(ChannelTable.from_channels(channels))
+        if final_channels:
+            publish_playlist(final_channels)
+        return bool(final_channels)
+
+async def run_daemon(serve=False):
+    """Service mode: one warm session, rolling re-validation and republishing until stopped"""
+    logging.info("=" * 60)
+    logging.info("IPTV GENERATOR - DAEMON MODE (rolling re-validation)")
+    logging.info(
+        f"Probe rate: {DAEMON_PROBE_RATE}/s steady, {DAEMON_STARTUP_PROBE_RATE}/s at startup | "
+        f"max streams: {DAEMON_MAX_STREAMS}"
+    )
+    logging.info("=" * 60)
+    
+    server = runner = None
+    if serve:
+        server = PlaylistServer()
+        await server.reload()
+        runner = await start_server(server)
+    
+    try:
+        async with create_session(CachingResolver()) as session:
+            daemon = RevalidationDaemon(session, HealthCache().load(),
+                                        on_publish=server.reload if server else None)
+            await daemon.run()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+# =======================================================================================
+# LOCAL HTTP SERVER (playlist + shards from memory)
+# =======================================================================================
+
+CONTENT_TYPES = {
+    '.m3u': 'audio/x-mpegurl; charset=utf-8',
+    '.json': 'application/json; charset=utf-8',
+}
+
+class StaticBody:
+    """One published file held in memory with its precompressed variants and strong ETags"""
+    
+    __slots__ = ['digest', 'content_type', 'variants']
+    
+    def __init__(self, data, content_type):
+        self.digest = hashlib.sha256(data).hexdigest()[:32]
+        self.content_type = content_type
+        # encoding -> (body, etag); mỗi encoding là một representation riêng nên ETag khác nhau
+        self.variants = {'identity': (data, f'"{self.digest}"')}
+        gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(gzipped) < len(data):
+            self.variants['gzip'] = (gzipped, f'"{self.digest}-gz"')
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                self.variants['br'] = (compressed, f'"{self.digest}-br"')
+
+    def negotiate(self, accept_encoding):
+        accepted = {token.split(';')[0].strip().lower() for token in accept_encoding.split(',')}
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.variants:
+                return encoding
+        return 'identity'
+
+def parse_byte_range(header, size):
+    """(start, end) inclusive for a single 'bytes=' range, None to ignore it, or 'invalid' (416)"""
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None  # Multi-range: trả về toàn bộ body (được phép theo RFC 9110)
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return 'invalid'
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return 'invalid'
+    return start, end
+
+class PlaylistServer:
+    """Serves playlist.m3u, its delta feed and the shards from memory
+    
+    reload() reads the published files into StaticBody objects and swaps the whole
+    table in one assignment, so a request always sees one consistent version;
+    files whose bytes did not change keep their compressed bodies. Reading and
+    compressing run in a worker thread so the event loop keeps serving (and probing).
+    """
+    
+    def __init__(self):
+        self.bodies = {}
+        self._signature = None
+        self._reloading = asyncio.Lock()
+
+    def published_files(self):
+        files = [OUTPUT_FILENAME, DELTA_FILENAME, FALLBACK_FILENAME]
+        index = load_shard_index()
+        if index:
+            files.append(SHARD_INDEX_FILENAME)
+            files.extend(
+                os.path.join(SHARD_DIR, entry['file'])
+                for shards in index['shards'].values() for entry in shards.values()
+            )
+        return files
+
+    async def reload(self):
+        async with self._reloading:
+            # gzip 9 / brotli 11 trên playlist lớn mất vài giây CPU: chạy trên loop sẽ chặn
+            # các probe đang bay và cộng thời gian chờ đó vào ping của chúng
+            loop = asyncio.get_running_loop()
+            bodies = await loop.run_in_executor(None, self._load, self.bodies)
+            self.bodies = bodies
+            self._signature = self._published_signature()
+        logging.info(f"Server: serving {len(bodies)} files")
+
+    def _load(self, previous):
+        """Worker thread: read the published files, compressing only those whose bytes changed"""
+        bodies = {}
+        for path in self.published_files():
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            route = path.replace(os.sep, '/')
+            body = previous.get(route)
+            if body is None or body.digest != hashlib.sha256(data).hexdigest()[:32]:
+                body = StaticBody(data, CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream'))
+            bodies[route] = body
+        
+        if OUTPUT_FILENAME in bodies:
+            bodies[''] = bodies[OUTPUT_FILENAME]
+        return bodies
+
+    def _published_signature(self):
+        signature = []
+        for path in (OUTPUT_FILENAME, SHARD_INDEX_FILENAME):
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return signature
+
+    async def watch(self):
+        """Pick up files published by another process (cron run of main())"""
+        while True:
+            await asyncio.sleep(SERVE_RELOAD_INTERVAL)
+            if self._published_signature() != self._signature:
+                await self.reload()
+
+    async def handle(self, request):
+        body = self.bodies.get(request.match_info['path'])
+        if body is None:
+            return web.Response(status=404, text='Not found')
+        
+        encoding = body.negotiate(request.headers.get('Accept-Encoding', ''))
+        data, etag = body.variants[encoding]
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={SERVE_MAX_AGE}',
+            'Vary': 'Accept-Encoding',
+            'Accept-Ranges': 'bytes',
+            'Content-Type': body.content_type,
+        }
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
         
-        semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if '*' in tags or etag in tags:
+                return web.Response(status=304, headers=headers)
         
-        for i in range(0, len(all_channels), BATCH_SIZE):
-            batch = all_channels[i:i+BATCH_SIZE]
-            check_tasks = [check_channel_status(session, ch, semaphore) for ch in batch]
-            await asyncio.gather(*check_tasks)
+        byte_range = request.headers.get('Range')
+        if_range = request.headers.get('If-Range')
+        if byte_range is not None and (if_range is None or if_range == etag):
+            span = parse_byte_range(byte_range, len(data))
+            if span == 'invalid':
+                headers['Content-Range'] = f'bytes */{len(data)}'
+                return web.Response(status=416, headers=headers)
+            if span is not None:
+                start, end = span
+                headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+                return web.Response(status=206, body=data[start:end + 1], headers=headers)
+        
+        return web.Response(body=data, headers=headers)
+
+async def start_server(server, host=SERVE_HOST, port=SERVE_PORT):
+    app = web.Application()
+    app.router.add_get('/{path:.*}', server.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Server: listening on http://{host}:{port}/")
+    return runner
+
+async def run_server():
+    """Serve the files already published on disk, reloading when a new run replaces them"""
+    server = PlaylistServer()
+    await server.reload()
+    runner = await start_server(server)
+    try:
+        await server.watch()
+    finally:
+        await runner.cleanup()
+
+# =======================================================================================
+# MAIN
+# =======================================================================================
+
+async def main():
+    """Main execution with enhanced quality filtering"""
+    start_time = datetime.now()
+    logging.info("=" * 60)
+    logging.info("IPTV GENERATOR - OPTIMIZED QUALITY MODE")
+    logging.info("Strategy: Prioritize 1080p+, Remove low-quality tags, Fast ping")
+    logging.info("=" * 60)
+    
+    # Catalogue dạng cột ngay từ lúc nạp: không có list IPTVChannel cho toàn bộ kênh
+    table = ChannelTable()
+    index = RowIndex(table)
+    
+    resolver = CachingResolver()
+    async with create_session(resolver) as session:
+        health_cache = HealthCache().load()
+        source_yield = SourceYield().load()
+        sweep = EndpointSweep(resolver) if PREPROBE_SWEEP else None
+        stage_started = time.perf_counter()
+        
+        if PIPELINE_MODE:
+            # Phase 1+2: Fetch, pre-filter and check concurrently
+            logging.info("\n[1-2/3] FETCHING + CHECKING (pipelined)")
+            logging.info("-" * 60)
+            
+            scheduler = ProbeScheduler(session, health_cache, backlog=PIPELINE_QUEUE_SIZE,
+                                       source_yield=source_yield.rates, deadline=PROBE_DEADLINE, sweep=sweep,
+                                       index=index)
+            await run_pipeline(session, scheduler, table)
+            logging.info(f"Channels after pre-filter (removed low-quality & blocked): {len(table)}")
+        else:
+            # Phase 1: Fetch sources
+            logging.info("\n[1/3] FETCHING SOURCES")
+            logging.info("-" * 60)
+            
+            async def fetch_records(url, category):
+                return [record async for record in iter_source_records(session, url, category)]
             
-            checked = i + len(batch)
-            if checked % (BATCH_SIZE * 5) == 0 or checked == len(all_channels):
-                logging.info(f"Progress: {checked}/{len(all_channels)}")
+            sources = [(category, url) for category, urls in SOURCES.items() for url in urls]
+            results = await asyncio.gather(
+                *(fetch_records(url, category) for category, url in sources),
+                return_exceptions=True
+            )
+            
+            # Pre-filter by quality before checking (chỉ loại bỏ kênh RÕ RÀNG chất lượng thấp)
+            for (_, url), result in zip(sources, results):
+                if not isinstance(result, list):
+                    continue
+                for record in result:
+                    if IPTVChannel.record_is_high_quality(record):
+                        table.append_record(record, url)
+                        METRICS.inc('iptv_source_channels_total', source=url, stage='prefiltered')
+            results = None
+            logging.info(f"Channels after pre-filter (removed low-quality & blocked): {len(table)}")
+            
+            # Phase 2: Check channels
+            logging.info("\n[2/3] CHECKING CHANNELS (Quality-Optimized)")
+            logging.info("-" * 60)
+            
+            scheduler = ProbeScheduler(session, health_cache, source_yield=source_yield.rates,
+                                       deadline=PROBE_DEADLINE, sweep=sweep, index=index)
+            await scheduler.run([table.channel(row) for row in range(len(table)) if index.add_row(row)])
+        
+        METRICS.set('iptv_stage_seconds', round(time.perf_counter() - stage_started, 3), stage='fetch_check')
+        if not len(table):
+            logging.error("No channels passed pre-filter (all are low-quality or blocked)!")
+            write_run_report(start_time)
+            return
+        
+        if DEEP_VALIDATION and not scheduler.expired:
+            stage_started = time.perf_counter()
+            await deep_validate(session, index, health_cache)
+            METRICS.set('iptv_stage_seconds', round(time.perf_counter() - stage_started, 3), stage='deep_validation')
+        
+        reused = health_cache.trusted_working + health_cache.skipped_dead
+        logging.info(
+            f"Health cache: reused {reused}/{len(table)} verdicts "
+            f"({health_cache.trusted_working} working, {health_cache.skipped_dead} dead in backoff)"
+        )
+        reasons = defaultdict(int)
+        working = 0
+        for source, status, reason in table.outcomes():
+            if status == 'dead':
+                reasons[reason or 'unknown'] += 1
+            elif status == 'working':
+                working += 1
+                METRICS.inc('iptv_source_channels_total', source=source, stage='working')
+        for reason, count in reasons.items():
+            METRICS.inc('iptv_probe_failures_total', count, reason=reason)
+        METRICS.set('iptv_channels', len(table), stage='prefiltered')
+        METRICS.set('iptv_channels', working, stage='working')
+        logging.info("Failure reasons: " + ', '.join(
+            f"{reason} {count}" for reason, count in sorted(reasons.items(), key=lambda item: -item[1])
+        ))
+        health_cache.save()
+        source_yield.update((source, status) for source, status, _ in table.outcomes())
+        source_yield.save()
+        export_probe_timings(table.timed_channels())
+    await resolver.close()
+    
+    # Bước lọc chỉ cần bảng: bỏ index (url_key -> row) và scheduler trước
+    unique_streams, probes_saved = len(index.groups), index.probes_saved
+    scheduler = index = None
     
     # Phase 3: Filter and generate
     logging.info("\n[3/3] GENERATING OPTIMIZED OUTPUT")
     logging.info("-" * 60)
     
-    final_channels = filter_and_deduplicate(all_channels)
+    stage_started = time.perf_counter()
+    final_channels = filter_and_deduplicate(table)
+    METRICS.set('iptv_stage_seconds', round(time.perf_counter() - stage_started, 3), stage='filter')
     
     if not final_channels:
         logging.error("No channels passed all filters!")
+        write_run_report(start_time)
         return
     
-    content = generate_m3u_playlist(final_channels)
+    stage_started = time.perf_counter()
+    publish_playlist(final_channels)
+    METRICS.set('iptv_stage_seconds', round(time.perf_counter() - stage_started, 3), stage='publish')
     
-    # Save
-    with open(OUTPUT_FILENAME, 'w', encoding='utf-8') as f:
-        f.write(content)
+    METRICS.set('iptv_channels', len(final_channels), stage='final')
+    for ch in final_channels:
+        METRICS.inc('iptv_source_channels_total', source=ch.source, stage='final')
+    write_run_report(start_time)
     
     duration = datetime.now() - start_time
     minutes = int(duration.total_seconds() / 60)
@@ -524,9 +3570,29 @@ async def main():
     logging.info("\n" + "=" * 60)
     logging.info(f"✓✓✓ SUCCESS! Generated {len(final_channels)} OPTIMIZED channels")
     logging.info(f"Strategy: Prioritized 1080p+, removed low-quality, ping <={MAX_ACCEPTABLE_PING_MS}ms")
+    logging.info(f"Probes: {unique_streams} unique streams, {probes_saved} duplicate probes saved")
     logging.info(f"Execution time: {minutes}m {seconds}s")
     logging.info(f"Playlist saved to: {OUTPUT_FILENAME}")
     logging.info("=" * 60)
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="High-quality IPTV playlist generator")
+    parser.add_argument('--daemon', action='store_true', help="Keep running and re-validate channels continuously")
+    parser.add_argument('--serve', action='store_true', help="Serve the playlist and shards over HTTP")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    configure_logging()
+    args = parse_args()
+    if args.daemon:
+        entry = run_daemon(serve=args.serve)
+    elif args.serve:
+        entry = run_server()
+    else:
+        entry = main()
+    try:
+        asyncio.run(entry)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_parse_pool()